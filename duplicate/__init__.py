@@ -10,9 +10,18 @@
 
 from __future__ import absolute_import
 
+from .archives import MemberInfo, findmembers
 from .core import CACHE
 from .deplicate import Deplicate
-from .structs import Cache, ResultInfo, SkipException
+from .distributed import Coordinator
+from .estimate import Estimate, estimate
+from .export import tocsv, tojsonl, tosqlite
+from .index import (DupIndex, HashIndex, ScanIndex, XattrCache,
+                    diffindexes)
+from .purgeplan import PlanError, PurgePlan, apply_plan
+from .structs import (Cache, LazyResult, ProgressInfo, ResultInfo, ScanContext,
+                      SkipException)
+from .trees import findtrees, purgetrees
 from .utils import from_iterable
 
 
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import os
+import tarfile
+import zipfile
+import zlib
+
+from collections import defaultdict, namedtuple
+from contextlib import closing
+
+from .core import rulematch, scanfiles
+from .deplicate import Deplicate
+from .utils import from_iterable
+
+_READSIZE = 1 << 20  #: bytes
+_NOBOUNDS = (0, (1 << 63) - 1)  #: bytes
+
+_TAREXTS = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2',
+            '.tbz2')
+_ZIPEXTS = ('.zip',)
+
+_MemberInfo = namedtuple('MemberInfo', 'path archive name size crc')
+
+
+class MemberInfo(_MemberInfo):
+    """
+    Member of a zip or tar archive, as a virtual file.
+    """
+    __slots__ = []
+
+
+def _archivetype(path):
+    lpath = path.lower()
+
+    if lpath.endswith(_ZIPEXTS):
+        return zipfile
+
+    elif lpath.endswith(_TAREXTS):
+        return tarfile
+
+    return None
+
+
+def _zipmembers(archive):
+    with closing(zipfile.ZipFile(archive)) as zf:
+        return [MemberInfo(os.path.join(archive, zi.filename), archive,
+                           zi.filename, zi.file_size, zi.CRC)
+                for zi in zf.infolist() if not zi.filename.endswith('/')]
+
+
+def _tarmembers(archive):
+    #: Headers are spread all over the stream, so it's read to the end
+    with closing(tarfile.open(archive)) as tf:
+        return [MemberInfo(os.path.join(archive, ti.name), archive,
+                           ti.name, ti.size, None)
+                for ti in tf if ti.isfile()]
+
+
+def _members(fileinfo, onerror):
+    archivetype = _archivetype(fileinfo.path)
+
+    if archivetype is None:
+        return []
+
+    try:
+        if archivetype is zipfile:
+            return _zipmembers(fileinfo.path)
+        return _tarmembers(fileinfo.path)
+
+    except (IOError, OSError, EOFError,
+            zipfile.BadZipfile, tarfile.TarError) as exc:
+        if onerror is not None:
+            onerror(exc, fileinfo.path)
+        return []
+
+
+def _streamsum(fp, hasher):
+    x = hasher.new()
+    update = x.update
+    crc = 0
+
+    data = fp.read(_READSIZE)
+    while data:
+        update(data)
+        crc = zlib.crc32(data, crc)
+        data = fp.read(_READSIZE)
+
+    return crc & 0xffffffff, hasher.digest(x)
+
+
+def _filesums(records, sums, hasher, onerror):
+    for record in records:
+        try:
+            with open(record.path, 'rb') as fp:
+                sums[record.path] = _streamsum(fp, hasher)
+
+        except (IOError, OSError) as exc:
+            if onerror is not None:
+                onerror(exc, record.path)
+
+
+def _membersums(archive, records, sums, hasher, onerror):
+    wanted = dict((record.name, record) for record in records)
+
+    try:
+        if _archivetype(archive) is zipfile:
+            with closing(zipfile.ZipFile(archive)) as zf:
+                for name, record in wanted.items():
+                    with closing(zf.open(name)) as fp:
+                        sums[record.path] = _streamsum(fp, hasher)
+            return
+
+        #: One pass in stream order, as compressed tars can't seek back
+        with closing(tarfile.open(archive)) as tf:
+            for ti in tf:
+                record = wanted.get(ti.name)
+                if record is None or not ti.isfile():
+                    continue
+                with closing(tf.extractfile(ti)) as fp:
+                    sums[record.path] = _streamsum(fp, hasher)
+
+    except (IOError, OSError, EOFError, RuntimeError,
+            zipfile.BadZipfile, tarfile.TarError) as exc:
+        if onerror is not None:
+            onerror(exc, archive)
+
+
+def _hashrecords(records, sums, hasher, onerror):
+    files = []
+    members = defaultdict(list)
+
+    for record in records:
+        if record.path in sums:
+            continue
+        if isinstance(record, MemberInfo):
+            members[record.archive].append(record)
+        else:
+            files.append(record)
+
+    _filesums(files, sums, hasher, onerror)
+
+    for archive, memberlist in members.items():
+        _membersums(archive, memberlist, sums, hasher, onerror)
+
+
+def _hasmember(records):
+    return any(isinstance(record, MemberInfo) for record in records)
+
+
+def _crcgroups(buckets, sums):
+    for records in buckets:
+        crcdict = defaultdict(list)
+
+        for record in records:
+            if isinstance(record, MemberInfo) and record.crc is not None:
+                crc = record.crc
+            else:
+                try:
+                    crc, _ = sums[record.path]
+                except KeyError:
+                    continue
+            crcdict[crc].append(record)
+
+        for crclist in crcdict.values():
+            if len(crclist) > 1 and _hasmember(crclist):
+                yield crclist
+
+
+def _sizebuckets(files, d, onerror):
+    minsize, maxsize = d.sizes
+    scanempties = d.scnflags[0]
+
+    #: Bounds apply to what is compared, never to the archives holding it
+    fileminsize = minsize if scanempties else max(minsize, 1)
+    minsize = max(minsize, 1)
+
+    sizedict = defaultdict(list)
+
+    for fileinfo in files:
+        if fileminsize <= fileinfo.size <= maxsize:
+            sizedict[fileinfo.size].append(fileinfo)
+
+        for member in _members(fileinfo, onerror):
+            if not minsize <= member.size <= maxsize:
+                continue
+            if not rulematch(member.path, *d.matchers):
+                continue
+            sizedict[member.size].append(member)
+
+    return [records for records in sizedict.values()
+            if len(records) > 1 and _hasmember(records)]
+
+
+@from_iterable
+def findmembers(*paths, **kwargs):
+    """
+    Find the archive members duplicating other files or members,
+    the largest first.
+    """
+    onerror = kwargs.pop('onerror', None)
+
+    d = Deplicate(paths, **kwargs)
+
+    #: Archives are looked into whatever their size
+    dupdict, _, _ = scanfiles(d.paths, _NOBOUNDS, d.matchers, d.recursive,
+                              d.followlinks, d.scanlinks, d.scnflags,
+                              onerror, None)
+
+    files = [fileinfo for filelist in dupdict.values()
+             for fileinfo in filelist]
+
+    #: Members join the size buckets of the scanned files
+    buckets = _sizebuckets(files, d, onerror)
+
+    #: Zip members are keyed by their stored CRC32 for free, anything else
+    #: is read once for both its CRC32 and its digest
+    sums = {}
+    _hashrecords([record for records in buckets for record in records
+                  if not isinstance(record, MemberInfo) or record.crc is None],
+                 sums, d.hasher, onerror)
+
+    crcgroups = list(_crcgroups(buckets, sums))
+
+    #: Zip members are decompressed only on a CRC32 collision
+    _hashrecords([record for records in crcgroups for record in records],
+                 sums, d.hasher, onerror)
+
+    groups = []
+
+    for records in crcgroups:
+        digestdict = defaultdict(list)
+
+        for record in records:
+            try:
+                _, digest = sums[record.path]
+            except KeyError:
+                continue
+            digestdict[digest].append(record)
+
+        for duplist in digestdict.values():
+            if len(duplist) > 1 and _hasmember(duplist):
+                groups.append(duplist)
+
+    groups.sort(key=lambda duplist: duplist[0].size, reverse=True)
+
+    return tuple(tuple(sorted(record.path for record in duplist))
+                 for duplist in groups)
@@ -4,72 +4,201 @@ from __future__ import absolute_import
 
 import os
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from contextlib import closing
-from filecmp import cmp as filecmp
+from functools import partial
+from itertools import islice
 from math import ceil
 from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 from os.path import abspath
 from stat import S_IFMT, S_ISLNK
 
-import xxhash
+from .spill import SpillDict
+from .structs import CACHE, DupTable, FileInfo, FilterType, SkipException
+from .utils import gethasher, hashsum
+from .utils.fs import (blksize, blocksums, checksum, directread, filecmp,
+                       fsdecode, fsencode, hashcmp, headsum,
+                       is_archived, is_hidden, is_system, physoffset, prefetch,
+                       readopen, removemany, sidesum, signature, sparsecmp,
+                       sparsesum, splitpaths, tailsum, walk)
 
-from .structs import Cache, DupInfo, FileInfo, FilterType, SkipException
-from .utils.fs import (blksize, checksum, fsdecode, is_archived, is_hidden,
-                       is_os64, is_system, remove, sidesum, signature,
-                       splitpaths, walk)
-
-
-_xxhash_xxh = xxhash.xxh64 if is_os64 else xxhash.xxh32
 
 _LINKSIZE = 900 if os.name == 'nt' else 60  #: bytes
 _LITTLESIZE = 100 << 10  #: bytes
 _BIGSIZE = 100 << 20  #: bytes
+_SMALLSIZE = _LITTLESIZE  #: bytes
+_SMALLBATCH = 16 << 20  #: bytes
 _SIZERATE = 10  #: percentage
 _BLKSIZE = 4 << 10
-_XXHSIZE = _xxhash_xxh().block_size << 11
+_SIGNSIZE = 261  #: bytes
+_PURGEBATCH = 256  #: files
+_PURGEWORKERS = 4
+_APPENDBLOCK = 16 << 20  #: bytes
+
 
-CACHE = Cache()
+def _iterpending(duptable):
+    for group, filelist in duptable:
+        #: Groups matched by content are final
+        if group.filter is FilterType.CONTENT:
+            continue
+        yield group, filelist
 
 
-def _iterdups(dupinfo):
-    for key, value in dupinfo.dups.items():
-        if isinstance(value, DupInfo):
-            for subobj, subkey, subvalue in _iterdups(value):
-                yield subobj, subkey, subvalue
-        else:
-            yield dupinfo, key, value
+def _reclaimable(dup):
+    _, filelist = dup
+    return (len(filelist) - 1) * filelist[0].size
+
+
+def _prioritized(dups, budget):
+    #: Biggest wins first, whatever the budget will be left to
+    if budget is not None:
+        dups.sort(key=_reclaimable, reverse=True)
+    return dups
+
+
+def _spent(duptable, group, filelist, budget):
+    if budget is None or not budget.exhausted():
+        return False
+
+    #: Drop the group from the table, as unverified
+    budget.deferred.append(filelist)
+    duptable.split(group, group.filter, {}, [], filelist)
+    return True
+
+
+def _readsize(fileinfo, extents):
+    return sum(length for _, length in extents(fileinfo))
 
 
-def _bufsize(fileinfo):
+def _groupsize(filelist, extents):
+    return sum(_readsize(fileinfo, extents) for fileinfo in filelist)
+
+
+def _planned(meter, dups, extents):
+    #: Bytes to be read by the stage, counted buffer by buffer by the rules
+    #: themselves (and never for the digests found cached)
+    if meter is not None:
+        meter.plan(sum(_groupsize(filelist, extents)
+                       for _, filelist in dups))
+
+
+def _bufsize(fileinfo, hasher, autotune=False, cache=CACHE):
     # NOTE: `stat.st_dev` is always zero in Python 2 under Windows. :(
     if fileinfo.dev:
         try:
-            blocksize = CACHE.get(fileinfo).blksize
+            if autotune:
+                return cache.tune(fileinfo)
+
+            blocksize = cache.get(fileinfo).blksize
 
         except Exception:
             blocksize = 1
     else:
         blocksize = blksize(fileinfo.path)
 
-    maxsize = max(blocksize, _XXHSIZE)
-    minsize = min(blocksize, _XXHSIZE)
+    hashsize = hasher.blocksize << 11
+    maxsize = max(blocksize, hashsize)
+    minsize = min(blocksize, hashsize)
     return maxsize - maxsize % minsize
 
 
-def _checksum(fileinfo):
+def _checksum(fileinfo, hasher, autotune, cache=CACHE, counter=None):
     try:
         if S_ISLNK(fileinfo.mode):
             link = os.readlink(fileinfo.path)
-            hashsum = _xxhash_xxh(link).hexdigest()
+            digest = hashsum(fsencode(link), hasher)
         else:
             raise AttributeError
 
     except AttributeError:
-        bufsize = _bufsize(fileinfo)
-        hashsum = checksum(fileinfo.path, bufsize)
+        bufsize = _bufsize(fileinfo, hasher, autotune, cache)
+        digest = checksum(fileinfo.path, bufsize, hasher, counter)
+
+    return digest
+
+
+def _sparsesum(fileinfo, hasher, autotune, cache=CACHE, counter=None):
+    if S_ISLNK(fileinfo.mode):
+        return _checksum(fileinfo, hasher, autotune, cache)
+
+    bufsize = _bufsize(fileinfo, hasher, autotune, cache)
+    return sparsesum(fileinfo.path, bufsize, hasher, counter)
+
+
+def _lastblocks(fileinfo, hashcache, name):
+    try:
+        entry = hashcache.getentry(fileinfo.path, 'blocks', name)
+    except AttributeError:
+        return (), 0
+
+    #: Only a file grown in place can resume from its former blocks
+    if entry is None:
+        return (), 0
+
+    size, _, inode, blocks = entry
+    if inode != fileinfo.inode or size >= fileinfo.size:
+        return (), 0
+
+    return blocks, size
+
+
+def _blocksum(fileinfo, hasher, autotune, hashcache, cache=CACHE,
+              counter=None):
+    if S_ISLNK(fileinfo.mode):
+        return _checksum(fileinfo, hasher, autotune, cache)
+
+    name = hasher.name
+    bufsize = _bufsize(fileinfo, hasher, autotune, cache)
+    path = fileinfo.path
+
+    blocks, size = _lastblocks(fileinfo, hashcache, name)
+
+    blocks = blocksums(path, _APPENDBLOCK, bufsize, hasher, blocks, size,
+                       counter)
+    if blocks is None:
+        blocks = blocksums(path, _APPENDBLOCK, bufsize, hasher,
+                           counter=counter)
+
+    if hashcache is not None:
+        hashcache.set(fileinfo, 'blocks', name, blocks)
+
+    data = repr((fileinfo.size, blocks)).encode('ascii')
+    return hashsum(data, hasher)
 
-    return hashsum
+
+def _filecmp(file0, file1, hasher, autotune, cache=CACHE, counter=None):
+    bufsize = _bufsize(file0, hasher, autotune, cache)
+    return filecmp(file0.path, file1.path, bufsize, counter)
+
+
+def _hashcmp(file0, file1, hasher, autotune, hashcache, cache=CACHE,
+             counter=None):
+    if S_ISLNK(file0.mode) or S_ISLNK(file1.mode):
+        return _filecmp(file0, file1, hasher, autotune, cache, counter)
+
+    name = hasher.name
+
+    digest0 = hashcache.get(file0, 'checksum', name)
+    digest1 = hashcache.get(file1, 'checksum', name)
+    if digest0 is not None and digest1 is not None:
+        return digest0 == digest1
+
+    bufsize = _bufsize(file0, hasher, autotune, cache)
+    digest = hashcmp(file0.path, file1.path, bufsize, hasher, counter)
+    if digest is None:
+        return False
+
+    #: Same digest of the hash filter, not to read the pair again later
+    hashcache.set(file0, 'checksum', name, digest)
+    hashcache.set(file1, 'checksum', name, digest)
+
+    return True
+
+
+def _sparsecmp(file0, file1, hasher, autotune, cache=CACHE, counter=None):
+    bufsize = _bufsize(file0, hasher, autotune, cache)
+    return sparsecmp(file0.path, file1.path, bufsize, counter)
 
 
 def _chksize(fileinfo):
@@ -81,15 +210,229 @@ def _chksize(fileinfo):
     return percsize // 2
 
 
-def _sidesum(fileinfo):
+def _sidesum(fileinfo, hasher, autotune, cache=CACHE, counter=None):
     chksize = _chksize(fileinfo)
-    bufsize = _bufsize(fileinfo)
-    hashsums = sidesum(fileinfo.path, chksize, bufsize)
+    bufsize = _bufsize(fileinfo, hasher, autotune, cache)
+    hashsums = sidesum(fileinfo.path, chksize, bufsize, hasher=hasher,
+                       counter=counter)
     return hashsums
 
 
-def _signature(fileinfo):
-    return signature(fileinfo.path)
+def _headsum(fileinfo, hasher, autotune, cache=CACHE, counter=None):
+    chksize = _chksize(fileinfo)
+    bufsize = _bufsize(fileinfo, hasher, autotune, cache)
+    return headsum(fileinfo.path, chksize, bufsize, hasher=hasher,
+                   counter=counter)
+
+
+def _tailsum(fileinfo, hasher, autotune, cache=CACHE, counter=None):
+    chksize = _chksize(fileinfo)
+    bufsize = _bufsize(fileinfo, hasher, autotune, cache)
+    return tailsum(fileinfo.path, chksize, bufsize, hasher=hasher,
+                   counter=counter)
+
+
+def _signature(fileinfo, hasher, counter=None):
+    return signature(fileinfo.path, hasher, counter)
+
+
+def _signextents(fileinfo):
+    return ((0, _SIGNSIZE),)
+
+
+def _sideextents(fileinfo):
+    chksize = _chksize(fileinfo)
+    return ((0, chksize), (fileinfo.size - chksize, chksize))
+
+
+def _headextents(fileinfo):
+    return ((0, _chksize(fileinfo)),)
+
+
+def _tailextents(fileinfo):
+    chksize = _chksize(fileinfo)
+    return ((fileinfo.size - chksize, chksize),)
+
+
+def _hashextents(fileinfo):
+    return ((0, fileinfo.size),)
+
+
+_EXTENTS = {
+    FilterType.SIGNATURE: _signextents,
+    FilterType.RULE: _sideextents,
+    FilterType.HASH: _hashextents
+}
+
+
+def _physkey(fileinfo, extents):
+    offset = extents(fileinfo)[0][0]
+
+    try:
+        physical = physoffset(fileinfo.path, offset)
+    except (IOError, OSError):
+        physical = None
+
+    #: Fallback to inode order, close enough on most file systems
+    if physical is None:
+        return fileinfo.dev, 1, fileinfo.inode, offset
+
+    return fileinfo.dev, 0, physical, 0
+
+
+def _advise(fileinfo, extents, maxsize):
+    size = 0
+    for offset, length in extents(fileinfo):
+        length = min(length, maxsize - size)
+        if length <= 0:
+            break
+        try:
+            prefetch(fileinfo.path, offset, length)
+        except (IOError, OSError):
+            break
+        size += length
+    return size
+
+
+def _prefetched(files, extents, prefetchsize, cachehit=None):
+    window = deque()
+    left = prefetchsize
+
+    #: Files with a cached digest won't be read at all
+    if cachehit is None:
+        ahead_it = iter(files)
+    else:
+        ahead_it = (fileinfo for fileinfo in files if not cachehit(fileinfo))
+
+    for fileinfo in files:
+        #: Keep the kernel busy reading the next files, within budget
+        while not window or left > 0:
+            try:
+                ahead = next(ahead_it)
+            except StopIteration:
+                break
+            size = _advise(ahead, extents, left)
+            window.append((ahead, size))
+            left -= size
+
+        yield fileinfo
+
+        if window and window[0][0] is fileinfo:
+            left += window.popleft()[1]
+
+
+def _prefetchrule(rule, dups, extents, prefetchsize, cachehit=None):
+    if not prefetchsize:
+        return rule
+
+    files = [fileinfo for _, filelist in dups for fileinfo in filelist]
+    files_it = _prefetched(files, extents, prefetchsize, cachehit)
+
+    def prefetchrule(fileinfo):
+        next(files_it)
+        return rule(fileinfo)
+
+    return prefetchrule
+
+
+def _sweep(rule, files, prefetchsize, extents, cachehit=None):
+    """
+    Apply rule to files in the physical order of their extents,
+    deferring results (and errors) to the returned rule.
+    """
+    files = sorted(files, key=partial(_physkey, extents=extents))
+    if prefetchsize:
+        files = _prefetched(files, extents, prefetchsize, cachehit)
+
+    results = {}
+
+    for fileinfo in files:
+        try:
+            results[id(fileinfo)] = (rule(fileinfo), None)
+        except Exception as exc:
+            results[id(fileinfo)] = (None, exc)
+
+    def sweptrule(fileinfo):
+        digest, exc = results.pop(id(fileinfo))
+        if exc is not None:
+            raise exc
+        return digest
+
+    return sweptrule
+
+
+def _sidesweep(_, files, prefetchsize, hasher, autotune, hashcache,
+               cache=CACHE, counter=None):
+    #: Every head first, then every tail, each pass in one direction
+    name = hasher.name
+    digests = {}
+    pending = []
+
+    for fileinfo in files:
+        digest = None
+        if hashcache is not None:
+            digest = hashcache.get(fileinfo, 'sidesum', name)
+
+        if digest is None:
+            pending.append(fileinfo)
+        else:
+            digests[id(fileinfo)] = digest
+
+    heads = _sweep(partial(_headsum, hasher=hasher, autotune=autotune,
+                           cache=cache, counter=counter),
+                   pending, prefetchsize, _headextents)
+    tails = _sweep(partial(_tailsum, hasher=hasher, autotune=autotune,
+                           cache=cache, counter=counter),
+                   pending, prefetchsize, _tailextents)
+
+    def sweptrule(fileinfo):
+        try:
+            return digests.pop(id(fileinfo))
+        except KeyError:
+            pass
+
+        try:
+            digest = heads(fileinfo)
+        finally:
+            tail = tails(fileinfo)
+        digest = (digest, tail)
+
+        if hashcache is not None:
+            hashcache.set(fileinfo, 'sidesum', name, digest)
+        return digest
+
+    return sweptrule
+
+
+def _cachehit(hashcache, kind, hasher):
+    if hashcache is None:
+        return None
+
+    name = hasher.name
+
+    def cachehit(fileinfo):
+        return hashcache.get(fileinfo, kind, name) is not None
+
+    return cachehit
+
+
+def cachedrule(rule, kind, hasher, hashcache):
+    """
+    Get a file key function looking up and storing its digests in a cache.
+    """
+    if hashcache is None:
+        return rule
+
+    name = hasher.name
+
+    def cached(fileinfo):
+        digest = hashcache.get(fileinfo, kind, name)
+        if digest is None:
+            digest = rule(fileinfo)
+            hashcache.set(fileinfo, kind, name, digest)
+        return digest
+
+    return cached
 
 
 def _filter(func, filelist, dupdict, errlist, onerror):
@@ -111,30 +454,51 @@ def _filter(func, filelist, dupdict, errlist, onerror):
     return dupdict, errlist
 
 
-def _rulefilter(fltrtype, dupinfo, check, rule, onerror, progress):
-    dups_it = _iterdups(dupinfo)
+def _rulefilter(fltrtype, duptable, check, rule, extents, onerror, progress,
+                prefetchsize, sweep=None, budget=None, meter=None,
+                cachehit=None):
+    dups = []
 
-    for dupobj, dupkey, filelist in dups_it:
+    for group, filelist in _iterpending(duptable):
         try:
             check(filelist)
 
         except SkipException:
             continue
 
+        dups.append((group, filelist))
+
+    #: A sweep reads everything up front, so it can't honor a budget
+    if sweep is None or budget is not None:
+        dups = _prioritized(dups, budget)
+        rule = _prefetchrule(rule, dups, extents, prefetchsize, cachehit)
+    else:
+        files = [fileinfo for _, filelist in dups for fileinfo in filelist]
+        rule = sweep(rule, files, prefetchsize)
+
+    _planned(meter, dups, extents)
+
+    for group, filelist in dups:
+        if _spent(duptable, group, filelist, budget):
+            continue
+
         dupdict, errlist = _filter(rule, filelist, defaultdict(list), [],
                                    onerror)
 
-        DupInfo(fltrtype, dupdict, errlist, dupobj, dupkey)
+        duptable.split(group, fltrtype, dupdict, errlist, filelist)
+
+        if budget is not None:
+            budget.charge(_groupsize(filelist, extents))
 
         if progress is not None:
             progress(len(filelist))
 
 
-def _binarycmp(filelist, onerror):
+def _binarycmp(filelist, cmp, onerror):
     file0, file1 = filelist
 
     try:
-        if filecmp(file0.path, file1.path, shallow=False):
+        if cmp(file0, file1):
             dupdict = {True: filelist}
         else:
             dupdict = {}
@@ -149,10 +513,11 @@ def _binarycmp(filelist, onerror):
     return dupdict, errlist
 
 
-def _binaryfilter(fltrtype, dupinfo, onerror, progress):
-    dups_it = _iterdups(dupinfo)
+def _binaryfilter(fltrtype, duptable, cmp, onerror, progress, prefetchsize,
+                  ordered=False, budget=None, meter=None, cachehit=None):
+    dups = []
 
-    for dupobj, dupkey, filelist in dups_it:
+    for group, filelist in _iterpending(duptable):
         try:
             file0, _ = filelist
         except ValueError:
@@ -162,27 +527,210 @@ def _binaryfilter(fltrtype, dupinfo, onerror, progress):
         if not file0.size:
             continue
 
-        dupdict, errlist = _binarycmp(filelist, onerror)
+        dups.append((group, filelist))
+
+    if budget is not None:
+        _prioritized(dups, budget)
+
+    elif ordered:
+        def sort_fn(dup):
+            return _physkey(dup[1][0], _hashextents)
+
+        dups.sort(key=sort_fn)
+
+    #: Pairs with both digests cached are compared without reading
+    if cachehit is not None:
+        cached = set()
+        for _, filelist in dups:
+            if all(map(cachehit, filelist)):
+                cached.update(map(id, filelist))
+
+        def cachehit(fileinfo):
+            return id(fileinfo) in cached
+
+    advance = _prefetchrule(lambda f: None, dups, _hashextents, prefetchsize,
+                            cachehit)
+
+    _planned(meter, dups, _hashextents)
+
+    for group, filelist in dups:
+        for fileinfo in filelist:
+            advance(fileinfo)
+
+        if _spent(duptable, group, filelist, budget):
+            continue
+
+        dupdict, errlist = _binarycmp(filelist, cmp, onerror)
 
-        DupInfo(fltrtype, dupdict, errlist, dupobj, dupkey)
+        duptable.split(group, fltrtype, dupdict, errlist, filelist)
+
+        if budget is not None:
+            budget.charge(2 * filelist[0].size)
 
         if progress is not None:
             progress(2)
 
 
-def _typefilter(fltrtype, dupinfo, onerror, progress):
-    dups_it = _iterdups(dupinfo)
+def _smallread(fileinfo, hasher=None):
+    path = fileinfo.path
+
+    try:
+        if S_ISLNK(fileinfo.mode):
+            data = os.readlink(path)
+        else:
+            #: One byte more, not to match a file grown since scanned
+            with readopen(path, sequential=True) as (read, _):
+                data = read(fileinfo.size + 1)
+
+            if len(data) != fileinfo.size:
+                raise IOError(
+                    'File size changed since scanned: {0}'.format(path))
+
+        if hasher is not None:
+            data = hashsum(fsencode(data), hasher)
+
+    except (IOError, OSError) as exc:
+        return fileinfo, None, exc
+
+    return fileinfo, data, None
+
+
+def _smallbatches(dups):
+    batch = []
+    batchsize = 0
+
+    for group, filelist in dups:
+        groupsize = filelist[0].size * len(filelist)
+
+        #: A group bigger than a batch goes alone, keyed by digest
+        if groupsize > _SMALLBATCH:
+            yield [(group, filelist)], True
+            continue
+
+        if batch and batchsize + groupsize > _SMALLBATCH:
+            yield batch, False
+            batch = []
+            batchsize = 0
+
+        batch.append((group, filelist))
+        batchsize += groupsize
+
+    if batch:
+        yield batch, False
+
+
+def _smallgroup(results, onerror):
+    dupdict = defaultdict(list)
+    errlist = []
+
+    for fileinfo, data, exc in results:
+        if exc is None:
+            dupdict[data].append(fileinfo)
+            continue
+
+        if onerror is not None:
+            onerror(exc, fileinfo.path)
+        errlist.append(fileinfo)
+
+    #: Don't keep file contents around as group keys
+    dupdict = dict(enumerate(dupdict.values(), 1))
+
+    return dupdict, errlist
+
+
+def _smallbudget(duptable, batch, budget):
+    if budget is None:
+        return batch
+
+    dups = []
+
+    #: Charged up front, the whole batch being read at once
+    for group, filelist in batch:
+        if _spent(duptable, group, filelist, budget):
+            continue
+        budget.charge(_groupsize(filelist, _hashextents))
+        dups.append((group, filelist))
+
+    return dups
+
+
+def _smallsplit(fltrtype, duptable, dups, pool, onerror, progress,
+                meter=None, hasher=None, budget=None):
+    dups = _prioritized(dups, budget)
+
+    _planned(meter, dups, _hashextents)
+
+    for batch, hashed in _smallbatches(dups):
+        batch = _smallbudget(duptable, batch, budget)
+        if not batch:
+            continue
+
+        files = [fileinfo for _, filelist in batch for fileinfo in filelist]
+        read = partial(_smallread, hasher=hasher) if hashed else _smallread
+        results_it = iter(pool.map(read, files))
+
+        for group, filelist in batch:
+            results = islice(results_it, len(filelist))
+            dupdict, errlist = _smallgroup(results, onerror)
+
+            duptable.split(group, fltrtype, dupdict, errlist, filelist)
+
+            if meter is not None:
+                meter.advance(_groupsize(filelist, _hashextents))
+
+            if progress is not None:
+                progress(len(filelist))
+
+
+def _smallfilter(fltrtype, duptable, check, onerror, progress, context=None,
+                 hasher=None, budget=None):
+    dups = []
+
+    for group, filelist in _iterpending(duptable):
+        try:
+            check(filelist)
+
+        except SkipException:
+            continue
+
+        dups.append((group, filelist))
 
-    for dupobj, dupkey, filelist in dups_it:
-        dupdict, errlist = _filter(lambda f: f[fltrtype], filelist,
-                                   defaultdict(list), [], onerror)
+    if context is not None:
+        pool = context.getpool()
+        return _smallsplit(fltrtype, duptable, dups, pool, onerror, progress,
+                           context.progress, hasher, budget)
 
-        DupInfo(fltrtype, dupdict, errlist, dupobj, dupkey)
+    with closing(ThreadPool()) as pool:
+        _smallsplit(fltrtype, duptable, dups, pool, onerror, progress,
+                    hasher=hasher, budget=budget)
+
+
+def _typefilter(fltrtype, duptable, onerror, progress):
+    #: Refine by every given attribute at once, keyed on their tuple
+    try:
+        key = itemgetter(*fltrtype)
+    except TypeError:
+        key = itemgetter(fltrtype)
+    else:
+        fltrtype = tuple(fltrtype)
+
+    for group, filelist in duptable:
+        dupdict, errlist = _filter(key, filelist, defaultdict(list), [],
+                                   onerror)
+
+        duptable.split(group, fltrtype, dupdict, errlist, filelist)
 
         if progress is not None:
             progress(len(filelist))
 
 
+def _smallcheck(filelist):
+    size = filelist[0].size
+
+    if not size or size >= _SMALLSIZE:
+        raise SkipException
+
+
 def _signcheck(filelist):
     # if len(filelist) < 2:
         # raise SkipException
@@ -217,56 +765,84 @@ def _hashcheck(filelist):
         raise SkipException
 
 
-def _sizecheck(size, minsize, maxsize, scanempties):
-    if not size and not scanempties:
-        raise SkipException
-
-    elif not minsize <= size <= maxsize:
-        raise SkipException
+def _sizefilter(filelist, minsize, maxsize, scanempties):
+    if not scanempties:
+        minsize = max(minsize, 1)
 
+    return [fileinfo for fileinfo in filelist
+            if minsize <= fileinfo.size <= maxsize]
 
-def _rulecheck(path, included_match, excluded_match):
-    if excluded_match(path):
-        raise SkipException
 
-    elif not included_match(path):
-        raise SkipException
+def rulematch(path, included_match, excluded_match):
+    """
+    Whether path is matched by the include rules and not by the exclude ones.
+    """
+    return included_match(path) and not excluded_match(path)
 
 
-def _attrcheck(path, scansystem, scanarchived, scanhidden):
+def _attrmatch(path, scansystem, scanarchived, scanhidden):
     if not scanhidden and is_hidden(path):
-        raise SkipException
+        return False
 
     elif not scanarchived and is_archived(path):
-        raise SkipException
+        return False
 
     elif not scansystem and is_system(path):
-        raise SkipException
+        return False
+
+    return True
 
 
-def _filecheck(fileinfo, minsize, maxsize, included_match, excluded_match,
-               scanempties, scansystem, scanarchived, scanhidden):
+def _scanfilter(filelist, dupdict, errlist, scnargs, onerror):
+    (minsize, maxsize, included_match, excluded_match,
+     scanempties, scansystem, scanarchived, scanhidden) = scnargs
 
-    _sizecheck(fileinfo.size, minsize, maxsize, scanempties)
-    _rulecheck(fileinfo.path, included_match, excluded_match)
-    _attrcheck(fileinfo.path, scansystem, scanarchived, scanhidden)
+    #: Cheap bounds are applied to the whole batch before the per-file checks
+    filelist = _sizefilter(filelist, minsize, maxsize, scanempties)
+    added = []
 
-    return S_IFMT(fileinfo.mode), fileinfo.size
+    for fileinfo in filelist:
+        path = fileinfo.path
 
+        try:
+            if not rulematch(path, included_match, excluded_match):
+                continue
+
+            if not _attrmatch(path, scansystem, scanarchived, scanhidden):
+                continue
+
+        except Exception as exc:
+            if onerror is not None:
+                onerror(exc, path)
+            errlist.append(fileinfo)
+
+        else:
+            dupdict[fileinfo.id].append(fileinfo)
+            added.append(fileinfo)
+
+    if isinstance(dupdict, SpillDict):
+        dupdict.account(added)
+
+    return dupdict, errlist
+
+
+def _splitpaths(paths, followlinks, context=None):
+    if context is not None:
+        upaths = context.getpool().imap(fsdecode, paths)
+        return splitpaths(set(upaths), followlinks)
 
-def _splitpaths(paths, followlinks):
     with closing(ThreadPool()) as pool:
         upaths = pool.imap(fsdecode, paths)
     return splitpaths(set(upaths), followlinks)
 
 
-def _names_to_info(names, onerror):
+def _names_to_info(names, onerror, counter=None):
     filelist = []
     errlist = []
 
     for filename in names:
         try:
-            fileinfo = FileInfo(filename)
+            fileinfo = FileInfo(filename, counter=counter)
 
         except (IOError, OSError) as exc:
             filepath = abspath(filename)
@@ -280,14 +856,14 @@ def _names_to_info(names, onerror):
     return filelist, errlist
 
 
-def _entries_to_info(entries, onerror):
+def _entries_to_info(entries, onerror, counter=None):
     filelist = []
     errlist = []
 
     for entry in entries:
         try:
             st = entry.stat(follow_symlinks=False)
-            fileinfo = FileInfo(entry.name, entry.path, st)
+            fileinfo = FileInfo(entry.name, entry.path, st, counter)
 
         except (IOError, OSError) as exc:
             if onerror is not None:
@@ -301,15 +877,12 @@ def _entries_to_info(entries, onerror):
 
 
 def _filescan(filenames, dupdict, errlist, scnerrlist,
-              scnargs, onerror, progress):
+              scnargs, onerror, progress, counter=None):
 
-    filelist, _scnerrlist = _names_to_info(filenames, onerror)
+    filelist, _scnerrlist = _names_to_info(filenames, onerror, counter)
     scnerrlist.extend(_scnerrlist)
 
-    def rule(fileinfo):
-        return _filecheck(fileinfo, *scnargs)
-
-    _filter(rule, filelist, dupdict, errlist, onerror)
+    _scanfilter(filelist, dupdict, errlist, scnargs, onerror)
 
     if progress is not None:
         progress(len(filelist))
@@ -318,7 +891,8 @@ def _filescan(filenames, dupdict, errlist, scnerrlist,
 
 
 def _dirscan(dirnames, dupdict, errlist, scnerrlist,
-             scnargs, onerror, followlinks, scanlinks, progress):
+             scnargs, onerror, followlinks, scanlinks, progress,
+             counter=None):
 
     if onerror is None:
         def callback(exc):
@@ -329,9 +903,6 @@ def _dirscan(dirnames, dupdict, errlist, scnerrlist,
             onerror(exc, filepath)
             scnerrlist.append(filepath)
 
-    def rule(fileinfo):
-        return _filecheck(fileinfo, *scnargs)
-
     seen = set()
     for dirname in dirnames:
         walk_it = walk(dirname, callback, followlinks, seen)
@@ -340,10 +911,11 @@ def _dirscan(dirnames, dupdict, errlist, scnerrlist,
             if scanlinks:
                 files += links
 
-            filelist, _scnerrlist = _entries_to_info(files, onerror)
+            filelist, _scnerrlist = _entries_to_info(files, onerror,
+                                                     counter)
             scnerrlist.extend(_scnerrlist)
 
-            _filter(rule, filelist, dupdict, errlist, onerror)
+            _scanfilter(filelist, dupdict, errlist, scnargs, onerror)
 
             if progress is not None:
                 progress(len(filelist))
@@ -351,88 +923,340 @@ def _dirscan(dirnames, dupdict, errlist, scnerrlist,
     return dupdict, errlist, scnerrlist
 
 
-def filterdups(fltrtype, dupinfo, onerror, progress):
+def filerule(fltrtype, hasher=None, autotune=False, sparse=False,
+             incremental=False, hashcache=None, cache=None, counter=None):
+    """
+    Get the group check and the file key function of an I/O filter.
+    """
+    hasher = gethasher(hasher)
 
-    # progress(0)
+    if cache is None:
+        cache = CACHE
+
+    if sparse:
+        hashrule = _sparsesum
+    elif incremental:
+        hashrule = partial(_blocksum, hashcache=hashcache)
+    else:
+        hashrule = _checksum
 
     if fltrtype is FilterType.SIGNATURE:
-        _rulefilter(fltrtype, dupinfo, _signcheck, _signature, onerror,
-                    progress)
+        return _signcheck, partial(_signature, hasher=hasher, counter=counter)
 
     elif fltrtype is FilterType.RULE:
+        return _sidecheck, partial(_sidesum, hasher=hasher, autotune=autotune,
+                                   cache=cache, counter=counter)
+
+    elif fltrtype is FilterType.HASH:
+        return _hashcheck, partial(hashrule, hasher=hasher,
+                                   autotune=autotune, cache=cache,
+                                   counter=counter)
+
+    raise ValueError('Not a rule filter: {0}'.format(fltrtype))
+
+
+def readsize(fileinfo, fltrtype):
+    """
+    Get the amount of bytes read from a file by an I/O filter.
+    """
+    try:
+        extents = _EXTENTS[fltrtype]
+    except KeyError:
+        raise ValueError('Not a rule filter: {0}'.format(fltrtype))
+
+    return _readsize(fileinfo, extents)
+
+
+def splitfiles(key, filelist, onerror):
+    """
+    Group files by a key function, the ones raising an error apart.
+    """
+    return _filter(key, filelist, defaultdict(list), [], onerror)
+
+
+def filterdups(fltrtype, duptable, onerror, progress, prefetchsize=0,
+               hasher=None, autotune=False, hashcache=None, sparse=False,
+               ordered=False, incremental=False, budget=None, context=None):
+
+    # progress(0)
+
+    hasher = gethasher(hasher)
+    cache = CACHE if context is None else context.cache
+    meter = None if context is None else context.progress
+    cached = partial(cachedrule, hasher=hasher, hashcache=hashcache)
+    cachehit = partial(_cachehit, hashcache, hasher=hasher)
+
+    if ordered:
+        def swept(extents, kind):
+            return partial(_sweep, extents=extents, cachehit=cachehit(kind))
+    else:
+        def swept(extents, kind):
+            return None
+
+    if fltrtype is FilterType.CONTENT:
+        _smallfilter(fltrtype, duptable, _smallcheck, onerror, progress,
+                     context, hasher, budget)
+
+    elif fltrtype is FilterType.SIGNATURE:
+        check, rule = filerule(fltrtype, hasher, autotune, cache=cache,
+                               counter=meter)
+        _rulefilter(fltrtype, duptable, check, cached(rule, 'signature'),
+                    _signextents, onerror, progress, prefetchsize,
+                    swept(_signextents, 'signature'), budget, meter,
+                    cachehit('signature'))
+
+    elif fltrtype is FilterType.RULE:
+        #: Direct reads bypass the page cache a prefetch fills
+        if directread():
+            prefetchsize = 0
+
         # NOTE: Just a one-pass check for now...
-        _rulefilter(fltrtype, dupinfo, _sidecheck, _sidesum, onerror, progress)
+        check, rule = filerule(fltrtype, hasher, autotune, cache=cache,
+                               counter=meter)
+        sweep = None
+        if ordered:
+            sweep = partial(_sidesweep, hasher=hasher, autotune=autotune,
+                            hashcache=hashcache, cache=cache, counter=meter)
+        _rulefilter(fltrtype, duptable, check, cached(rule, 'sidesum'),
+                    _sideextents, onerror, progress, prefetchsize, sweep,
+                    budget, meter, cachehit('sidesum'))
 
     elif fltrtype is FilterType.HASH:
-        _rulefilter(fltrtype, dupinfo, _hashcheck, _checksum, onerror,
-                    progress)
+        #: Sparse and block digests differ from the plain ones
+        if sparse:
+            kind = 'sparsesum'
+        elif incremental:
+            kind = 'blocksum'
+        else:
+            kind = 'checksum'
+            if directread():
+                prefetchsize = 0
+        check, rule = filerule(fltrtype, hasher, autotune, sparse,
+                               incremental, hashcache, cache, meter)
+        _rulefilter(fltrtype, duptable, check, cached(rule, kind),
+                    _hashextents, onerror, progress, prefetchsize,
+                    swept(_hashextents, kind), budget, meter, cachehit(kind))
 
     elif fltrtype is FilterType.BINARY:
-        _binaryfilter(fltrtype, dupinfo, onerror, progress)
+        if sparse:
+            cmp = partial(_sparsecmp, hasher=hasher, autotune=autotune,
+                          cache=cache, counter=meter)
+        elif hashcache is not None:
+            cmp = partial(_hashcmp, hasher=hasher, autotune=autotune,
+                          hashcache=hashcache, cache=cache, counter=meter)
+        else:
+            cmp = partial(_filecmp, hasher=hasher, autotune=autotune,
+                          cache=cache, counter=meter)
+        _binaryfilter(fltrtype, duptable, cmp, onerror, progress,
+                      prefetchsize, ordered, budget, meter,
+                      None if sparse else cachehit('checksum'))
 
     else:
-        _typefilter(fltrtype, dupinfo, onerror, progress)
+        _typefilter(fltrtype, duptable, onerror, progress)
 
-    return dupinfo
+    return duptable
 
 
-def _filepurge(filepath, duplist, errlist, trash, onerror):
-    try:
-        remove(filepath, trash)
+def _vetoed(filelist, ondel):
+    if not ondel:
+        return filelist
+
+    duplist = []
+
+    for fileinfo in filelist:
+        try:
+            ondel(fileinfo.path)
+        except SkipException:
+            continue
+
+        duplist.append(fileinfo)
+
+    return duplist
+
+
+def _purgebatches(filelist):
+    batches = defaultdict(list)
+
+    for fileinfo in filelist:
+        dirname, filename = os.path.split(fileinfo.path)
+        batches[fileinfo.dev, dirname].append(filename)
+
+    #: One device after the other, one directory at a time
+    for (_, dirname), names in sorted(batches.items()):
+        for i in range(0, len(names), _PURGEBATCH):
+            yield dirname, names[i:i + _PURGEBATCH]
+
 
+def _batchpurge(trash, batch):
+    dirname, names = batch
+
+    try:
+        errors = removemany(dirname, names, trash)
     except Exception as exc:
-        if onerror is not None:
-            onerror(exc, filepath)
-        errlist.append(filepath)
+        errors = [(name, exc) for name in names]
 
-    else:
-        duplist.append(filepath)
+    return dirname, names, errors
 
 
-def _purge(filelist, duplist, errlist, trash, ondel, onerror):
-    if ondel:
-        for fileinfo in filelist:
-            filepath = fileinfo.path
+def _purge(filelist, duplist, errlist, trash, onerror, progress, workers):
+    batches = _purgebatches(filelist)
+    purge = partial(_batchpurge, trash)
 
-            try:
-                ondel(filepath)
-            except SkipException:
-                continue
+    with closing(ThreadPool(workers)) as pool:
+        for dirname, names, errors in pool.imap_unordered(purge, batches):
+            failed = set()
 
-            _filepurge(filepath, duplist, errlist, trash, onerror)
-    else:
-        for fileinfo in filelist:
-            _filepurge(fileinfo.path, duplist, errlist, trash, onerror)
+            for name, exc in errors:
+                filepath = os.path.join(dirname, name)
+                if onerror is not None:
+                    onerror(exc, filepath)
+                errlist.append(filepath)
+                failed.add(name)
 
-    return duplist, errlist
+            duplist.extend(os.path.join(dirname, name)
+                           for name in names if name not in failed)
 
+            if progress is not None:
+                progress(len(names))
 
-def purgedups(dupinfo, trash, ondel, onerror, progress):
+    duplist.sort()
+    errlist.sort()
+
+    return duplist, errlist
 
-    # progress(0)
 
+def purgefiles(filelist, trash, ondel, onerror, progress,
+               workers=_PURGEWORKERS):
+    """
+    Purge the given files, skipping the ones vetoed by ondel.
+    """
     delduplist = []
     delerrlist = []
 
+    duplist = _vetoed(filelist, ondel)
+
+    if progress is not None:
+        progress(len(filelist) - len(duplist))
+
+    _purge(duplist, delduplist, delerrlist, trash, onerror, progress,
+           workers)
+
+    return delduplist, delerrlist
+
+
+def prunedups(duptable, refs):
+    """
+    Drop the groups made of reference files only.
+    """
+    def has_candidates(filelist):
+        return any(fileinfo.index not in refs for fileinfo in filelist)
+
+    duptable.prune(has_candidates)
+
+    return duptable
+
+
+def purgeable(filelist, refs=()):
+    """
+    Get the files of a duplicate group to be purged.
+    """
     # NOTE: Keep the oldest of firsts
     def sort_fn(obj):
         return obj.index, -obj.mtime, obj.path
 
-    dups_it = _iterdups(dupinfo)
+    duplist = [fileinfo for fileinfo in filelist
+               if fileinfo.index not in refs]
+
+    #: Candidates with a copy in the reference set are all redundant
+    if len(duplist) == len(filelist):
+        duplist = sorted(duplist, key=sort_fn)[1:]
+
+    return duplist
+
+
+def purgedups(duptable, trash, ondel, onerror, progress, refs=(),
+              workers=_PURGEWORKERS):
+
+    # progress(0)
+
+    delduplist = []
+    delerrlist = []
 
-    for _, _, filelist in dups_it:
-        duplist = sorted(filelist, key=sort_fn)[1:]
+    purgelist = []
 
-        _purge(duplist, delduplist, delerrlist, trash, ondel, onerror)
+    for _, filelist in duptable:
+        duplist = _vetoed(purgeable(filelist, refs), ondel)
+        purgelist.extend(duplist)
 
         if progress is not None:
-            progress(len(filelist))
+            progress(len(filelist) - len(duplist))
+
+    _purge(purgelist, delduplist, delerrlist, trash, onerror, progress,
+           workers)
 
     return delduplist, delerrlist
 
 
+def _scan(paths, dupdict, errlist, scnerrlist, scnargs, recursive,
+          followlinks, scanlinks, onerror, progress, context=None):
+
+    counter = None if context is None else context.counter
+
+    splitted_paths = _splitpaths(paths, followlinks, context)
+    dirnames, filenames, linknames, _, errnames = splitted_paths
+
+    scnerrlist.extend(errnames)
+
+    if scanlinks:
+        filenames += linknames
+
+    _filescan(filenames, dupdict, errlist, scnerrlist, scnargs, onerror,
+              progress, counter)
+
+    if recursive:
+        _dirscan(dirnames, dupdict, errlist, scnerrlist, scnargs, onerror,
+                 followlinks, scanlinks, progress, counter)
+
+    return dupdict, errlist, scnerrlist
+
+
+def scanfiles(paths, sizes, matchers, recursive, followlinks, scanlinks,
+              flags, onerror, progress, context=None):
+    """
+    Scan paths for the files to compare, single ones by size included.
+    """
+    dupdict = defaultdict(list)
+    errlist = []
+    scnerrlist = []
+
+    scnargs = sizes + matchers + flags
+
+    return _scan(paths, dupdict, errlist, scnerrlist, scnargs, recursive,
+                 followlinks, scanlinks, onerror, progress, context)
+
+
+def _refmerge(dupdict, refdict):
+    refs = set()
+
+    for key, reflist in refdict.items():
+        #: Sizes without candidates are never compared
+        if key not in dupdict:
+            continue
+
+        filelist = dupdict[key]
+        paths = set(fileinfo.path for fileinfo in reflist)
+
+        filelist[:] = [fileinfo for fileinfo in filelist
+                       if fileinfo.path not in paths]
+        filelist.extend(reflist)
+
+        refs.update(fileinfo.index for fileinfo in reflist)
+
+    return refs
+
+
 def scandups(paths, sizes, matchers, recursive, followlinks, scanlinks, flags,
-             onerror, progress):
+             onerror, progress, refpaths=(), context=None):
 
     # progress(0)
 
@@ -441,22 +1265,59 @@ def scandups(paths, sizes, matchers, recursive, followlinks, scanlinks, flags,
     scnerrlist = []
 
     scnargs = sizes + matchers + flags
+    scnopts = (recursive, followlinks, scanlinks, onerror, progress,
+               context)
 
-    splitted_paths = _splitpaths(paths, followlinks)
-    dirnames, filenames, linknames, _, errnames = splitted_paths
+    _scan(paths, dupdict, errlist, scnerrlist, scnargs, *scnopts)
 
-    scnerrlist.extend(errnames)
+    refs = set()
 
-    if scanlinks:
-        filenames += linknames
+    if refpaths:
+        refdict = defaultdict(list)
+        _scan(refpaths, refdict, errlist, scnerrlist, scnargs, *scnopts)
+        refs = _refmerge(dupdict, refdict)
 
-    _filescan(filenames, dupdict, errlist, scnerrlist, scnargs, onerror,
-              progress)
+    duptable = DupTable(dupdict, errlist)
 
-    if recursive:
-        _dirscan(dirnames, dupdict, errlist, scnerrlist, scnargs, onerror,
-                 followlinks, scanlinks, progress)
+    return duptable, scnerrlist, refs
+
+
+def _batchdups(dupdict, refdict, errlist):
+    try:
+        for batch in dupdict.batches(refdict):
+            refs = _refmerge(batch, refdict)
+            yield DupTable(batch, errlist), refs
+
+            #: Errors are reported with the first batch only
+            errlist = []
+
+        if errlist:
+            yield DupTable({}, errlist), set()
+
+    finally:
+        dupdict.close()
+
+
+def scanbatches(paths, sizes, matchers, recursive, followlinks, scanlinks,
+                flags, onerror, progress, refpaths=(), budget=0,
+                context=None):
+    """
+    Scan paths within a memory budget (in bytes), spilling to disk,
+    and iterate the duplicate tables of batches of sizes, one at a time.
+    """
+    dupdict = SpillDict(budget)
+    errlist = []
+    scnerrlist = []
+
+    scnargs = sizes + matchers + flags
+    scnopts = (recursive, followlinks, scanlinks, onerror, progress,
+               context)
+
+    _scan(paths, dupdict, errlist, scnerrlist, scnargs, *scnopts)
+
+    refdict = defaultdict(list)
 
-    dupinfo = DupInfo(FilterType.ID, dupdict, errlist)
+    if refpaths:
+        _scan(refpaths, refdict, errlist, scnerrlist, scnargs, *scnopts)
 
-    return dupinfo, scnerrlist
+    return _batchdups(dupdict, refdict, errlist), scnerrlist
@@ -2,37 +2,60 @@
 
 from __future__ import absolute_import
 
-from .core import CACHE, filterdups, purgedups, scandups
-from .structs import FilterType, ResultInfo
-from .utils import compilecards
+from functools import partial
+from operator import attrgetter
+
+from .core import filterdups, prunedups, purgedups, scanbatches, scandups
+from .index import HashIndex
+from .purgeplan import PurgePlan
+from .structs import (Budget, DupTable, FilterType, LazyResult, Progress,
+                      ResultInfo, ScanContext)
+from .utils import compilecards, gethasher
 
 
 class Deplicate(object):
 
-    __slots__ = ['_deldups', '_delerrors', '_dupinfo', '_scnerrors',
-                 'cmpflags', 'followlinks', 'matchers', 'paths', 'recursive',
-                 'result', 'scanlinks', 'scnflags', 'sizes']
+    __slots__ = ['_batches', '_budget', '_context', '_deldups', '_delerrors',
+                 '_dups', '_duptable', '_refs', '_scnerrors', 'autotune',
+                 'cmpflags', 'context', 'followlinks', 'hashcache', 'hasher',
+                 'incremental', 'interval', 'lazy', 'makeplan', 'matchers',
+                 'maxmemory', 'maxread', 'maxtime', 'ordered', 'paths',
+                 'plan', 'prefetchsize', 'recursive', 'reference', 'result',
+                 'scanlinks', 'scnflags', 'sizes', 'sparse', 'unverified']
 
     #: bytes
     DEFAULT_MINSIZE = 100 << 10
     DEFAULT_MAXSIZE = 100 << 30
+    DEFAULT_PREFETCHSIZE = 32 << 20
 
     def __init__(self, paths, minsize=DEFAULT_MINSIZE, maxsize=DEFAULT_MAXSIZE,
                  include=None, exclude=None,
                  comparename=False, comparemtime=False, comparemode=False,
                  recursive=True, followlinks=False, scanlinks=False,
                  scanempties=False, scansystem=True, scanarchived=True,
-                 scanhidden=True):
+                 scanhidden=True, prefetchsize=DEFAULT_PREFETCHSIZE,
+                 hasher=None, autotune=False, reference=None,
+                 hashcache=None, makeplan=False, sparse=False,
+                 ordered=False, incremental=False, maxmemory=None,
+                 lazy=False, maxtime=None, maxread=None, context=None,
+                 interval=None):
 
         if not paths:
             raise ValueError('Paths must not be empty')
 
-        self._dupinfo = None
+        self._batches = None
+        self._budget = None
+        self._context = None
+        self._dups = None
+        self._duptable = None
+        self._refs = None
         self._deldups = None
         self._scnerrors = None
         self._delerrors = None
 
         self.result = None
+        self.plan = None
+        self.unverified = None
 
         self.paths = paths
         self.sizes = (int(minsize), int(maxsize))
@@ -48,103 +71,222 @@ class Deplicate(object):
         self.scnflags = (scanempties, scansystem, scanarchived, scanhidden)
         self.cmpflags = (comparename, comparemtime, comparemode)
 
-    def _cpufilter(self, onerror, notify):
-        comparename, comparemtime, comparemode = self.cmpflags
-
+        self.prefetchsize = max(0, int(prefetchsize))
+        self.hasher = gethasher(hasher)
+        self.autotune = autotune
+        self.sparse = sparse
+        self.ordered = ordered
+        self.incremental = incremental
+        self.maxmemory = int(maxmemory or 0)
+        self.lazy = lazy
+        self.maxtime = maxtime
+        self.maxread = maxread
+        self.context = context
+        self.interval = interval
+
+        self.reference = tuple(reference or ())
+
+        #: Anything but a digest cache is taken as an index filename
+        if hashcache is not None and not hasattr(hashcache, 'get'):
+            hashcache = HashIndex(hashcache)
+
+        #: Keep the digests of the hash filter for the plan
+        if makeplan and hashcache is None:
+            hashcache = HashIndex()
+
+        self.hashcache = hashcache
+        self.makeplan = makeplan
+
+    def _progress(self, notify, message, metered=False):
         if notify is None:
-            progress_p = progress_m = progress_n = None
-        else:
-            def progress_p(value):
-                notify('filtering files by permission mode', value)
+            return None
+
+        #: Throttled, the stage just bumps the counters of the meter
+        meter = self._context.progress
+        if meter is not None:
+            meter.begin(message)
+            return None if metered else meter.advance
 
-            def progress_m(value):
-                notify('filtering files by modification time', value)
+        def progress(value):
+            notify(message, value)
 
-            def progress_n(value):
-                notify('filtering files by name', value)
+        return progress
+
+    def _prune(self):
+        if self._refs:
+            prunedups(self._duptable, self._refs)
+
+    def _cpufilter(self, onerror, notify):
+        comparename, comparemtime, comparemode = self.cmpflags
+
+        fltrtypes = []
+        subjects = []
 
         if comparemode:
-            filterdups(FilterType.MODE, self._dupinfo, onerror, progress_p)
+            fltrtypes.append(FilterType.MODE)
+            subjects.append('permission mode')
 
         if comparemtime:
-            filterdups(FilterType.MTIME, self._dupinfo, onerror, progress_m)
+            fltrtypes.append(FilterType.MTIME)
+            subjects.append('modification time')
 
         if comparename:
-            filterdups(FilterType.NAME, self._dupinfo, onerror, progress_n)
+            fltrtypes.append(FilterType.NAME)
+            subjects.append('name')
 
-    def _iofilter(self, onerror, notify):
+        if not fltrtypes:
+            return
 
-        if notify is None:
-            progress_s = progress_r = progress_h = progress_c = None
-        else:
-            def progress_s(value):
-                notify('filtering files by signature', value)
+        message = 'filtering files by {0}'.format(', '.join(subjects))
+        progress = self._progress(notify, message)
+
+        filterdups(fltrtypes, self._duptable, onerror, progress)
+        self._prune()
 
-            def progress_r(value):
-                notify('filtering files by rule', value)
+    def _iofilter(self, onerror, notify):
 
-            def progress_h(value):
-                notify('filtering files by hash', value)
+        iosettings = (self.prefetchsize, self.hasher, self.autotune,
+                      self.hashcache, self.sparse, self.ordered,
+                      self.incremental, self._budget, self._context)
 
-            def progress_c(value):
-                notify('filtering files by content', value)
+        stages = ((FilterType.CONTENT, 'filtering small files by content'),
+                  (FilterType.SIGNATURE, 'filtering files by signature'),
+                  (FilterType.RULE, 'filtering files by rule'),
+                  (FilterType.HASH, 'filtering files by hash'),
+                  (FilterType.BINARY, 'filtering files by content'))
 
         try:
-            CACHE.acquire()
-
-            filterdups(FilterType.SIGNATURE, self._dupinfo, onerror,
-                       progress_s)
-            filterdups(FilterType.RULE, self._dupinfo, onerror, progress_r)
-            filterdups(FilterType.HASH, self._dupinfo, onerror, progress_h)
-            filterdups(FilterType.BINARY, self._dupinfo, onerror, progress_c)
+            for fltrtype, message in stages:
+                #: Metered in bytes read by the filters themselves
+                progress = self._progress(notify, message, metered=True)
+                filterdups(fltrtype, self._duptable, onerror, progress,
+                           *iosettings)
+                self._prune()
 
         finally:
-            CACHE.release()
+            if self.hashcache is not None:
+                self.hashcache.commit()
 
     def _scan(self, onerror, notify):
 
-        if notify is None:
-            progress = None
-        else:
-            def progress(value):
-                notify('scanning for similar files', value)
+        progress = self._progress(notify, 'scanning for similar files')
+
+        scnargs = (self.paths, self.sizes, self.matchers, self.recursive,
+                   self.followlinks, self.scanlinks, self.scnflags,
+                   onerror, progress, self.reference)
+
+        #: The clock runs from the scan on
+        if self.maxtime or self.maxread:
+            self._budget = Budget(self.maxtime, self.maxread)
 
-        self._dupinfo, self._scnerrors = scandups(
-            self.paths, self.sizes, self.matchers,
-            self.recursive, self.followlinks, self.scanlinks, self.scnflags,
-            onerror, progress)
+        #: Sizes never compare across batches, each is filtered on its own
+        if self.maxmemory:
+            self._batches, self._scnerrors = scanbatches(
+                *scnargs, budget=self.maxmemory, context=self._context)
+        else:
+            duptable, self._scnerrors, refs = scandups(
+                *scnargs, context=self._context)
+            self._batches = iter([(duptable, refs)])
 
+        self._dups = DupTable({}, [])
         self._deldups = []
         self._delerrors = []
 
     def _purge(self, trash, ondel, onerror, notify):
 
-        if notify is None:
-            progress = None
-        else:
-            def progress(value):
-                notify('purging duplicates', value)
+        progress = self._progress(notify, 'purging duplicates')
 
-        self._deldups, self._delerrors = purgedups(
-            self._dupinfo, trash, ondel, onerror, progress)
+        deldups, delerrors = purgedups(
+            self._duptable, trash, ondel, onerror, progress, self._refs)
+
+        self._deldups.extend(deldups)
+        self._delerrors.extend(delerrors)
 
     def _filter(self, onerror, notify):
         self._cpufilter(onerror, notify)
         self._iofilter(onerror, notify)
 
-    def _find(self, onerror, notify):
-        self._scan(onerror, notify)
-        self._filter(onerror, notify)
+    def _find(self, onerror, notify, purge=None):
+        #: Scans of other instances share nothing but the device cache
+        if self.context is None:
+            self._context = ScanContext()
+        else:
+            self._context = self.context
+
+        if self.interval and notify is not None:
+            self._context.progress = Progress(notify, self.interval)
+            self._context.progress.start()
+
+        try:
+            self._scan(onerror, notify)
+
+            for self._duptable, self._refs in self._batches:
+                self._prune()
+                self._filter(onerror, notify)
+
+                if purge is not None:
+                    purge()
+
+                elif self.makeplan:
+                    self._plan(onerror, notify)
+
+                self._dups.update(self._duptable)
+
+        finally:
+            if self._context.progress is not None:
+                self._context.progress.stop()
+                self._context.progress = None
+
+            if self.context is None:
+                self._context.close()
+
+        self._duptable = self._dups
+
+    def _plan(self, onerror, notify):
+        meter = self._context.progress
+        if meter is not None:
+            meter.begin('planning purge')
+        elif notify is not None:
+            notify('planning purge')
+
+        plan = PurgePlan.build(self._duptable, self._refs, self.hasher,
+                               self.hashcache, onerror)
+
+        if self.plan is None:
+            self.plan = plan
+        else:
+            self.plan.groups.extend(plan.groups)
+
+    @staticmethod
+    def _unverified(deferred):
+        sort_fn = attrgetter('index', 'path')
+
+        def reclaimable(filelist):
+            return (len(filelist) - 1) * filelist[0].size
+
+        return tuple(tuple(sorted(filelist, key=sort_fn))
+                     for filelist in sorted(deferred, key=reclaimable,
+                                            reverse=True))
 
     def _result(self, notify):
         if notify is not None:
             notify('finalizing results')
 
-        self.result = ResultInfo(
-            self._dupinfo, self._deldups, self._scnerrors, self._delerrors)
+        resultcls = LazyResult if self.lazy else ResultInfo
+
+        self.result = resultcls(
+            self._duptable, self._deldups, self._scnerrors, self._delerrors)
+
+        if self._budget is not None:
+            self.unverified = self._unverified(self._budget.deferred)
 
         #: Cleanup
-        self._dupinfo = None
+        self._batches = None
+        self._budget = None
+        self._context = None
+        self._dups = None
+        self._duptable = None
+        self._refs = None
         self._deldups = None
         self._scnerrors = None
         self._delerrors = None
@@ -161,6 +303,7 @@ class Deplicate(object):
         if self.result is not None:
             raise RuntimeError('duplicates can only be found once')
 
-        self._find(onerror, notify)
-        self._purge(trash, ondel, onerror, notify)
+        purge = partial(self._purge, trash, ondel, onerror, notify)
+
+        self._find(onerror, notify, purge)
         self._result(notify)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from collections import defaultdict
+from multiprocessing import Pipe, Process
+
+from .core import filerule, scanfiles
+from .deplicate import Deplicate
+from .structs import (DupTable, FilterType, ResultInfo, ScanContext,
+                      SkipException)
+
+
+_STAGES = (FilterType.SIGNATURE, FilterType.RULE, FilterType.HASH)
+
+#: Options of `Deplicate` that workers can't honor
+_UNSUPPORTED = ('context', 'hashcache', 'incremental', 'interval', 'lazy',
+                'makeplan', 'maxmemory', 'maxread', 'maxtime', 'ordered',
+                'prefetchsize', 'reference')
+
+
+def _emptycheck(filelist):
+    if not filelist[0].size:
+        raise SkipException
+
+
+def _histogram(keys):
+    hist = defaultdict(int)
+    for key in keys:
+        hist[key] += 1
+    return dict(hist)
+
+
+def _colliding(hists):
+    total = defaultdict(int)
+
+    for hist in hists:
+        for key, count in hist.items():
+            total[key] += count
+
+    return set(key for key, count in total.items() if count > 1)
+
+
+class _Worker(object):
+
+    __slots__ = ['count', 'deplicate', 'entries', 'errors', 'errlist',
+                 'scnerrlist']
+
+    def __init__(self, paths, options):
+        self.deplicate = Deplicate(paths, **options)
+        self.count = 0
+        self.entries = []
+        self.errors = []
+        self.errlist = []
+        self.scnerrlist = []
+
+    def __onerror(self, exc, filename):
+        self.errors.append((exc, filename))
+
+    def __attrs(self):
+        comparename, comparemtime, comparemode = self.deplicate.cmpflags
+
+        attrs = []
+        if comparemode:
+            attrs.append('mode')
+        if comparemtime:
+            attrs.append('mtime')
+        if comparename:
+            attrs.append('name')
+
+        return attrs
+
+    def scan(self):
+        d = self.deplicate
+        context = ScanContext()
+
+        try:
+            dupdict, self.errlist, self.scnerrlist = scanfiles(
+                d.paths, d.sizes, d.matchers, d.recursive, d.followlinks,
+                d.scanlinks, d.scnflags, self.__onerror, None, context)
+        finally:
+            context.close()
+
+        #: Files are numbered from 1 in every shard
+        self.count = next(context.counter) - 1
+
+        #: Compared attributes are part of the key from the start
+        attrs = self.__attrs()
+        self.entries = [
+            (fileinfo, (key,) + tuple(getattr(fileinfo, a) for a in attrs))
+            for key, filelist in dupdict.items()
+            for fileinfo in filelist]
+
+        return _histogram(key for _, key in self.entries)
+
+    def filter(self, fltrtype, keys):
+        d = self.deplicate
+        check, rule = filerule(fltrtype, d.hasher, d.autotune, d.sparse)
+
+        #: Group sizes are only known to the coordinator
+        if fltrtype is FilterType.HASH:
+            check = _emptycheck
+
+        entries = []
+
+        for fileinfo, key in self.entries:
+            if key not in keys:
+                continue
+
+            try:
+                check([fileinfo])
+
+            except SkipException:
+                digest = None
+
+            else:
+                try:
+                    digest = rule(fileinfo)
+
+                except Exception as exc:
+                    self.__onerror(exc, fileinfo.path)
+                    self.errlist.append(fileinfo)
+                    continue
+
+            entries.append((fileinfo, key + (digest,)))
+
+        self.entries = entries
+
+        return _histogram(key for _, key in entries)
+
+    def result(self, keys):
+        dupdict = defaultdict(list)
+
+        for fileinfo, key in self.entries:
+            if key in keys:
+                dupdict[key].append(fileinfo)
+
+        return (dict(dupdict), self.errlist, self.scnerrlist, self.errors,
+                self.count)
+
+
+def _serve(conn, paths, options):
+    worker = _Worker(paths, options)
+
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+
+        command, args = request
+        try:
+            reply = getattr(worker, command)(*args)
+
+        except Exception as exc:
+            reply = exc
+
+        conn.send(reply)
+
+    conn.close()
+
+
+class Coordinator(object):
+    """
+    Find duplicates across shards of paths, each one scanned by a worker.
+    """
+    __slots__ = ['options', 'result', 'shards']
+
+    def __init__(self, shards, **options):
+        self.shards = [tuple(paths) for paths in shards]
+        self.options = options
+        self.result = None
+
+        if not self.shards:
+            raise ValueError('Shards must not be empty')
+
+        unsupported = sorted(name for name in options
+                             if name in _UNSUPPORTED)
+        if unsupported:
+            raise ValueError(
+                'Unsupported options: {0}'.format(', '.join(unsupported)))
+
+    @staticmethod
+    def __call(conns, command, *args):
+        for conn in conns:
+            conn.send((command, args))
+
+        replies = [conn.recv() for conn in conns]
+
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+
+        return replies
+
+    @staticmethod
+    def __start(shards, options):
+        conns = []
+        workers = []
+
+        for paths in shards:
+            conn, child_conn = Pipe()
+            worker = Process(target=_serve, args=(child_conn, paths, options))
+            worker.daemon = True
+            worker.start()
+
+            conns.append(conn)
+            workers.append(worker)
+
+        return conns, workers
+
+    @staticmethod
+    def __stop(conns, workers):
+        for conn in conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+
+        for worker in workers:
+            worker.join()
+
+    def __find(self, conns, notify):
+        call = self.__call
+
+        if notify is not None:
+            notify('scanning shards for similar files')
+
+        keys = _colliding(call(conns, 'scan'))
+
+        #: Each round keeps the keys colliding across all the shards
+        for fltrtype in _STAGES:
+            if notify is not None:
+                notify('filtering shards by {0}'.format(fltrtype.name.lower()))
+
+            keys = _colliding(call(conns, 'filter', fltrtype, keys))
+
+        return call(conns, 'result', keys)
+
+    def find(self, onerror=None, notify=None):
+        if self.result is not None:
+            raise RuntimeError('duplicates can only be found once')
+
+        conns, workers = self.__start(self.shards, self.options)
+        try:
+            replies = self.__find(conns, notify)
+        finally:
+            self.__stop(conns, workers)
+
+        dupdict = defaultdict(list)
+        errlist = []
+        scnerrlist = []
+
+        offset = 0
+
+        for subdict, suberrlist, subscnerrlist, errors, count in replies:
+            #: Shard after shard, as if scanned by a single process
+            for key, filelist in subdict.items():
+                dupdict[key].extend(f._replace(index=f.index + offset)
+                                    for f in filelist)
+
+            errlist.extend(f._replace(index=f.index + offset)
+                           for f in suberrlist)
+            scnerrlist.extend(subscnerrlist)
+
+            offset += count
+
+            if onerror is not None:
+                for exc, filename in errors:
+                    onerror(exc, filename)
+
+        if notify is not None:
+            notify('finalizing results')
+
+        duptable = DupTable(dupdict, errlist)
+        self.result = ResultInfo(duptable, [], scnerrlist, [])
+
+        return self.result
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import os
+
+from collections import namedtuple
+from math import erf, sqrt
+from random import Random
+from stat import S_ISLNK
+
+from .core import (cachedrule, filerule, filterdups, readsize, scandups,
+                   splitfiles)
+from .deplicate import Deplicate
+from .structs import FilterType, ScanContext, SkipException
+from .utils import from_iterable
+
+_SAMPLES = 256  #: groups
+_MEMBERS = 16  #: files
+
+_Estimate = namedtuple('Estimate',
+                       'size sizeinterval files filesinterval confidence '
+                       'readsize')
+
+
+class Estimate(_Estimate):
+
+    __slots__ = []
+
+
+def _zscore(confidence):
+    #: Two-sided normal quantile by bisection, as Python 2 has erf only
+    low, high = 0.0, 10.0
+    for _ in range(64):
+        mid = (low + high) / 2
+        if erf(mid / sqrt(2)) < confidence:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def _linkkey(fileinfo):
+    return os.readlink(fileinfo.path)
+
+
+def _distinct(filelist, check, partial, full, onerror):
+    """
+    Count the files hashed and their distinct contents, hashing in full
+    only the files whose partial digests collide.
+    """
+    file0 = filelist[0]
+    nread = 0
+
+    if S_ISLNK(file0.mode):
+        dupdict, _ = splitfiles(_linkkey, filelist, onerror)
+        return sum(map(len, dupdict.values())), len(dupdict), nread
+
+    try:
+        check(filelist)
+
+    except SkipException:
+        dupdict = {None: filelist}
+
+    else:
+        dupdict, _ = splitfiles(partial, filelist, onerror)
+        nread += readsize(file0, FilterType.RULE) * len(filelist)
+
+    hashed = distinct = 0
+
+    for sublist in dupdict.values():
+        if len(sublist) < 2:
+            hashed += len(sublist)
+            distinct += len(sublist)
+            continue
+
+        fulldict, _ = splitfiles(full, sublist, onerror)
+        nread += readsize(file0, FilterType.HASH) * len(sublist)
+
+        hashed += sum(map(len, fulldict.values()))
+        distinct += len(fulldict)
+
+    return hashed, distinct, nread
+
+
+def _ratiototal(samples, total, count, zscore):
+    """
+    Ratio estimate of a population total, with its confidence interval.
+    """
+    num = len(samples)
+    xsum = sum(x for x, _ in samples)
+    if not xsum:
+        return 0, (0, total)
+
+    ratio = sum(y for _, y in samples) / float(xsum)
+    value = ratio * total
+
+    if num < 2:
+        return int(round(value)), (0, total)
+
+    resid = sum((y - ratio * x) ** 2 for x, y in samples) / (num - 1)
+    variance = count ** 2 * (1 - num / float(count)) * resid / num
+    margin = zscore * sqrt(max(variance, 0))
+
+    low = max(0, value - margin)
+    high = min(total, value + margin)
+
+    return int(round(value)), (int(low), int(round(high)))
+
+
+@from_iterable
+def estimate(*paths, **kwargs):
+    """
+    Estimate the space taken by duplicate files, hashing a sample of them.
+    """
+    samples = int(kwargs.pop('samples', _SAMPLES))
+    members = max(2, int(kwargs.pop('members', _MEMBERS)))
+    confidence = float(kwargs.pop('confidence', 0.95))
+    seed = kwargs.pop('seed', None)
+    onerror = kwargs.pop('onerror', None)
+
+    d = Deplicate(paths, **kwargs)
+
+    #: Groups with a reference file are reclaimable in full, not sampled
+    if d.reference:
+        raise ValueError('Reference paths are not supported')
+
+    rnd = Random(seed)
+    context = ScanContext() if d.context is None else d.context
+
+    duptable, _, _ = scandups(d.paths, d.sizes, d.matchers, d.recursive,
+                              d.followlinks, d.scanlinks, d.scnflags,
+                              onerror, None, context=context)
+
+    fltrtypes = [fltrtype for fltrtype, flag in zip(
+        (FilterType.NAME, FilterType.MTIME, FilterType.MODE), d.cmpflags)
+        if flag]
+
+    #: Compared attributes split the groups before any read
+    if fltrtypes:
+        filterdups(fltrtypes, duptable, onerror, None)
+
+    groups = [filelist for _, filelist in duptable]
+
+    #: Every copy but one is reclaimable at most
+    maxfiles = sum(len(filelist) - 1 for filelist in groups)
+    maxsize = sum((len(filelist) - 1) * filelist[0].size
+                  for filelist in groups)
+
+    if len(groups) > samples:
+        groups = rnd.sample(groups, samples)
+
+    check, partial = filerule(FilterType.RULE, d.hasher, d.autotune,
+                              cache=context.cache)
+    partial = cachedrule(partial, 'sidesum', d.hasher, d.hashcache)
+    _, full = filerule(FilterType.HASH, d.hasher, d.autotune,
+                       cache=context.cache)
+    full = cachedrule(full, 'checksum', d.hasher, d.hashcache)
+
+    filesamples = []
+    sizesamples = []
+    readsize = 0
+
+    try:
+        for filelist in groups:
+            count = len(filelist)
+            size = filelist[0].size
+
+            if count > members:
+                filelist = rnd.sample(filelist, members)
+
+            hashed, distinct, nbytes = _distinct(filelist, check, partial,
+                                                 full, onerror)
+            readsize += nbytes
+
+            #: Nothing to learn from a group without two files hashed
+            if hashed < 2:
+                continue
+
+            dupfiles = (hashed - distinct) * (count - 1) / float(hashed - 1)
+
+            filesamples.append((count - 1, dupfiles))
+            sizesamples.append(((count - 1) * size, dupfiles * size))
+
+    finally:
+        if d.context is None:
+            context.close()
+
+        if d.hashcache is not None:
+            d.hashcache.commit()
+
+    zscore = _zscore(confidence)
+    population = max(len(duptable), len(sizesamples))
+
+    size, sizeinterval = _ratiototal(sizesamples, maxsize, population,
+                                     zscore)
+    files, filesinterval = _ratiototal(filesamples, maxfiles, population,
+                                       zscore)
+
+    return Estimate(size, sizeinterval, files, filesinterval, confidence,
+                    readsize)
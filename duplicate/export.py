@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import csv
+import io
+import json
+import sqlite3
+import sys
+
+from .utils.fs import fsdecode
+
+
+_SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dups (
+    grp INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL
+)
+'''
+
+_SQLITE_BATCH = 1 << 10  #: rows
+
+
+def _textopen(filename):
+    if sys.version_info[0] < 3:
+        return open(filename, 'wb')
+    return io.open(filename, 'w', encoding='utf-8', newline='')
+
+
+def _rows(result):
+    for num, duplist in enumerate(result.dups, 1):
+        size = duplist[0].size
+        yield num, size, [fsdecode(fileinfo.path) for fileinfo in duplist]
+
+
+def tojsonl(result, filename):
+    """
+    Write the duplicate groups of result as JSON lines, one group per line.
+    """
+    with _textopen(filename) as fp:
+        for num, size, paths in _rows(result):
+            line = json.dumps({'group': num, 'size': size, 'paths': paths})
+            fp.write(line + u'\n')
+
+
+def tocsv(result, filename):
+    """
+    Write the duplicate files of result as CSV rows of group, size and path.
+    """
+    with _textopen(filename) as fp:
+        writer = csv.writer(fp)
+        writer.writerow(('group', 'size', 'path'))
+
+        for num, size, paths in _rows(result):
+            writer.writerows((num, size, path) for path in paths)
+
+
+def tosqlite(result, filename):
+    """
+    Write the duplicate files of result in the `dups` table of a database.
+    """
+    conn = sqlite3.connect(filename)
+    try:
+        conn.execute(_SQLITE_SCHEMA)
+
+        batch = []
+        for num, size, paths in _rows(result):
+            batch.extend((num, size, path) for path in paths)
+
+            if len(batch) >= _SQLITE_BATCH:
+                conn.executemany('INSERT INTO dups VALUES (?, ?, ?)', batch)
+                batch = []
+
+        if batch:
+            conn.executemany('INSERT INTO dups VALUES (?, ?, ?)', batch)
+
+        conn.commit()
+
+    finally:
+        conn.close()
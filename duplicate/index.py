@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import errno
+import gzip
+import json
+import os
+import sqlite3
+
+from binascii import hexlify, unhexlify
+from collections import defaultdict
+from io import BytesIO
+from stat import S_ISREG
+from threading import RLock
+
+try:
+    from os import getxattr, removexattr, setxattr
+except ImportError:
+    getxattr = removexattr = setxattr = None
+
+from .utils import gethasher, hashsum
+from .utils.fs import checksum, readopen, splitpaths, walk
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    hasher TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest BLOB NOT NULL,
+    PRIMARY KEY (path, kind, hasher)
+)
+'''
+
+
+def _encode(digest):
+    if isinstance(digest, bytes):
+        return ['b', hexlify(digest).decode('ascii')]
+
+    elif isinstance(digest, tuple):
+        return ['t', [_encode(value) for value in digest]]
+
+    elif isinstance(digest, list):
+        return ['l', [_encode(value) for value in digest]]
+
+    return ['i', '{0:x}'.format(digest)]
+
+
+def _decode(data):
+    kind, value = data
+
+    if kind == 'b':
+        return unhexlify(value)
+
+    elif kind == 't':
+        return tuple(_decode(item) for item in value)
+
+    elif kind == 'l':
+        return [_decode(item) for item in value]
+
+    elif kind == 'i':
+        return int(value, 16)
+
+    raise ValueError('Unknown digest kind: {0}'.format(kind))
+
+
+#: Digests are stored as plain JSON text, never as pickles: the index
+#: file may be writable by others than the user running the scan
+def _dumps(digest):
+    return json.dumps(_encode(digest), separators=(',', ':'))
+
+
+def _loads(data):
+    #: Anything unreadable (like an entry of an older format) is a miss
+    try:
+        if isinstance(data, bytes):
+            data = data.decode('ascii')
+        return _decode(json.loads(data))
+    except (TypeError, ValueError):
+        return None
+
+
+class HashIndex(object):
+    """
+    Persistent index of file digests, trusted while file stat is unchanged.
+    """
+    __slots__ = ['__conn', 'filename', 'lock']
+
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self.lock = RLock()
+
+        self.__conn = sqlite3.connect(filename, check_same_thread=False)
+        self.__conn.execute(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, fileinfo, kind, hasher):
+        entry = self.getentry(fileinfo.path, kind, hasher)
+        if entry is None:
+            return None
+
+        size, mtime, inode, digest = entry
+        if (size, mtime, inode) != (fileinfo.size, fileinfo.mtime,
+                                    fileinfo.inode):
+            return None
+
+        return digest
+
+    def getentry(self, path, kind, hasher):
+        """
+        Get the stored `(size, mtime, inode, digest)` of file, even if stale.
+        """
+        with self.lock:
+            row = self.__conn.execute(
+                'SELECT size, mtime, inode, digest FROM digests '
+                'WHERE path = ? AND kind = ? AND hasher = ?',
+                (path, kind, hasher)).fetchone()
+
+        if row is None:
+            return None
+
+        size, mtime, inode, digest = row
+
+        digest = _loads(digest)
+        if digest is None:
+            return None
+
+        return size, mtime, inode, digest
+
+    def set(self, fileinfo, kind, hasher, digest):
+        with self.lock:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (fileinfo.path, kind, hasher, fileinfo.size,
+                 fileinfo.mtime, fileinfo.inode, _dumps(digest)))
+
+    def discard(self, path):
+        with self.lock:
+            self.__conn.execute('DELETE FROM digests WHERE path = ?', (path,))
+
+    def commit(self):
+        with self.lock:
+            self.__conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.__conn.commit()
+            self.__conn.close()
+
+
+_XATTR_PREFIX = 'user.deplicate.'
+
+
+def _xattrencode(digest):
+    if isinstance(digest, bytes):
+        return 'b' + hexlify(digest).decode('ascii')
+    return 'i{0:x}'.format(digest)
+
+
+def _xattrdecode(value):
+    if value[0] == 'b':
+        return unhexlify(value[1:])
+    return int(value[1:], 16)
+
+
+def _xattrdumps(fileinfo, digest):
+    #: Side digests are `(head, tail)` pairs
+    if isinstance(digest, tuple):
+        kind, value = 't', ','.join(map(_xattrencode, digest))
+    else:
+        kind, value = 'd', _xattrencode(digest)
+    return '{0}:{1}:{2}:{3}'.format(
+        fileinfo.size, fileinfo.mtime, kind, value).encode('ascii')
+
+
+def _xattrloads(fileinfo, data):
+    size, mtime, kind, value = data.decode('ascii').split(':')
+
+    if (int(size), int(mtime)) != (fileinfo.size, int(fileinfo.mtime)):
+        return None
+
+    if kind == 't':
+        return tuple(map(_xattrdecode, value.split(',')))
+    elif kind == 'd':
+        return _xattrdecode(value)
+    return None
+
+
+class XattrCache(object):
+    """
+    Digest cache stored in the extended attributes of each file,
+    trusted while file size and modification time are unchanged.
+    """
+    __slots__ = ['prefix', 'uid']
+
+    def __init__(self, prefix=_XATTR_PREFIX):
+        if getxattr is None:
+            raise OSError(
+                errno.ENOTSUP,
+                'Extended attributes are not supported on this platform')
+        self.prefix = prefix
+        self.uid = os.geteuid()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __name(self, kind, hasher):
+        return '{0}{1}.{2}'.format(self.prefix, kind, hasher)
+
+    def get(self, fileinfo, kind, hasher):
+        try:
+            #: Anyone able to write the file can forge its attributes
+            if os.lstat(fileinfo.path).st_uid != self.uid:
+                return None
+
+            data = getxattr(fileinfo.path, self.__name(kind, hasher),
+                            follow_symlinks=False)
+            return _xattrloads(fileinfo, data)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, fileinfo, kind, hasher, digest):
+        #: Lists of block digests don't fit in an attribute
+        if isinstance(digest, list):
+            return
+
+        #: Best effort, read-only files and file systems are common
+        try:
+            setxattr(fileinfo.path, self.__name(kind, hasher),
+                     _xattrdumps(fileinfo, digest), follow_symlinks=False)
+
+        except (IOError, OSError):
+            pass
+
+    def discard(self, path):
+        try:
+            names = os.listxattr(path, follow_symlinks=False)
+        except (IOError, OSError):
+            return
+
+        for name in names:
+            if not name.startswith(self.prefix):
+                continue
+            try:
+                removexattr(path, name, follow_symlinks=False)
+            except (IOError, OSError):
+                pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+_HEADSIZE = 64 << 10  #: bytes
+
+_FILES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    head BLOB,
+    full BLOB
+)
+'''
+
+_FILES_INDEX = 'CREATE INDEX IF NOT EXISTS files_size ON files (size)'
+
+
+def _stat(path):
+    st = os.stat(path)
+    try:
+        mtime = st.st_mtime_ns
+    except AttributeError:
+        mtime = st.st_mtime
+    return st, mtime
+
+
+def _streamsize(stream):
+    try:
+        return os.fstat(stream.fileno()).st_size - stream.tell()
+
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    try:
+        start = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell() - start
+        stream.seek(start)
+
+    except (AttributeError, IOError, OSError, ValueError):
+        size = None
+
+    return size
+
+
+def _readfull(read, size):
+    chunks = []
+    left = size
+
+    while left > 0:
+        data = read(left)
+        if not data:
+            break
+        chunks.append(data)
+        left -= len(data)
+
+    return b''.join(chunks)
+
+
+def _iterpaths(paths):
+    dirnames, filenames, _, _, _ = splitpaths(paths)
+
+    for filename in filenames:
+        yield os.path.abspath(filename)
+
+    for dirname in dirnames:
+        for _, files, _ in walk(dirname):
+            for entry in files:
+                yield entry.path
+
+
+def _headsum(path, headsize, hasher):
+    with readopen(path, sequential=True) as (read, _):
+        return hashsum(_readfull(read, headsize), hasher)
+
+
+class DupIndex(object):
+    """
+    Persistent index of stored files, queryable by content.
+    """
+    __slots__ = ['__conn', 'bufsize', 'filename', 'hasher', 'lock']
+
+    #: bytes
+    HEADSIZE = _HEADSIZE
+    DEFAULT_BUFSIZE = 1 << 20
+
+    def __init__(self, filename=':memory:', hasher=None,
+                 bufsize=DEFAULT_BUFSIZE):
+        self.filename = filename
+        self.hasher = gethasher(hasher)
+        self.bufsize = int(bufsize)
+        self.lock = RLock()
+
+        self.__conn = sqlite3.connect(filename, check_same_thread=False)
+        self.__conn.execute(_FILES_SCHEMA)
+        self.__conn.execute(_FILES_INDEX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.__conn.execute(
+                'SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def add(self, path):
+        """
+        Index a stored file; its digests are computed when first needed.
+        """
+        path = os.path.abspath(path)
+        st, mtime = _stat(path)
+
+        if not S_ISREG(st.st_mode):
+            raise ValueError('Not a regular file: {0}'.format(path))
+
+        with self.lock:
+            self.__conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL, NULL)',
+                (path, st.st_size, mtime, st.st_ino))
+
+    def scan(self, *paths, **kwargs):
+        """
+        Index the files in paths, recursing into directories.
+        """
+        onerror = kwargs.get('onerror')
+
+        for filename in _iterpaths(paths):
+            try:
+                self.add(filename)
+
+            except (IOError, OSError) as exc:
+                if onerror is not None:
+                    onerror(exc, filename)
+
+        self.commit()
+
+    def discard(self, path):
+        with self.lock:
+            self.__conn.execute('DELETE FROM files WHERE path = ?',
+                                (os.path.abspath(path),))
+
+    def __digest(self, row, column):
+        path, size, mtime, inode, head, full = row
+
+        try:
+            st, stmtime = _stat(path)
+
+            #: Changed or moved away since indexed, digests are stale
+            if (st.st_size, stmtime, st.st_ino) != (size, mtime, inode):
+                raise OSError
+
+            digest = head if column == 'head' else full
+            if digest is not None:
+                digest = _loads(digest)
+            if digest is not None:
+                return digest
+
+            if column == 'head':
+                digest = _headsum(path, self.HEADSIZE, self.hasher)
+            else:
+                digest = checksum(path, self.bufsize, self.hasher)
+
+        except (IOError, OSError):
+            self.discard(path)
+            return None
+
+        with self.lock:
+            self.__conn.execute(
+                'UPDATE files SET {0} = ? WHERE path = ?'.format(column),
+                (_dumps(digest), path))
+
+        return digest
+
+    def __candidates(self, size):
+        with self.lock:
+            return self.__conn.execute(
+                'SELECT path, size, mtime, inode, head, full FROM files '
+                'WHERE size = ?', (size,)).fetchall()
+
+    def __match(self, rows, column, digest):
+        return [row for row in rows
+                if self.__digest(row, column) == digest]
+
+    def __lookup(self, read, size):
+        rows = self.__candidates(size)
+        if not rows:
+            return ()
+
+        hasher = self.hasher
+        x = hasher.new()
+
+        data = _readfull(read, min(size, self.HEADSIZE))
+        x.update(data)
+
+        rows = self.__match(rows, 'head', hashsum(data, hasher))
+        if not rows or size <= self.HEADSIZE:
+            return tuple(row[0] for row in rows)
+
+        #: Go on with the full digest, without reading the head again
+        bufsize = self.bufsize
+        data = read(bufsize)
+        while data:
+            x.update(data)
+            data = read(bufsize)
+
+        rows = self.__match(rows, 'full', hasher.digest(x))
+        return tuple(row[0] for row in rows)
+
+    def lookup(self, source, size=None):
+        """
+        Find the indexed files with the same content of source,
+        a file path or a readable binary stream.
+        """
+        if hasattr(source, 'read'):
+            if size is None:
+                size = _streamsize(source)
+            if size is None:
+                data = source.read()
+                size = len(data)
+                source = BytesIO(data)
+            paths = self.__lookup(source.read, size)
+
+        else:
+            size = os.path.getsize(source)
+            with readopen(source, sequential=True) as (read, _):
+                paths = self.__lookup(read, size)
+
+        self.commit()
+
+        return paths
+
+    def commit(self):
+        with self.lock:
+            self.__conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.__conn.commit()
+            self.__conn.close()
+
+
+def _hexdigest(digest):
+    try:
+        return '{0:x}'.format(digest)
+    except ValueError:
+        return hexlify(digest).decode('ascii')
+
+
+class ScanIndex(object):
+    """
+    Exportable size index of a scan, with digests computed on request.
+    """
+    __slots__ = ['bufsize', 'entries', 'hasher', 'headsize', 'name']
+
+    def __init__(self, name, hasher=None, headsize=_HEADSIZE,
+                 bufsize=DupIndex.DEFAULT_BUFSIZE):
+        self.name = name
+        self.hasher = gethasher(hasher)
+        self.headsize = int(headsize)
+        self.bufsize = int(bufsize)
+
+        #: path -> [size, head digest, full digest]
+        self.entries = {}
+
+    @classmethod
+    def load(cls, filename):
+        with gzip.open(filename, 'rb') as fp:
+            lines = iter(fp)
+            header = json.loads(next(lines).decode('utf-8'))
+
+            index = cls(header['name'], header['hasher'], header['headsize'])
+            entries = index.entries
+
+            for line in lines:
+                path, size, head, full = json.loads(line.decode('utf-8'))
+                entries[path] = [size, head, full]
+
+        return index
+
+    def save(self, filename):
+        header = {'name': self.name, 'hasher': self.hasher.name,
+                  'headsize': self.headsize}
+
+        with gzip.open(filename, 'wb') as fp:
+            fp.write((json.dumps(header) + '\n').encode('utf-8'))
+
+            for path, entry in sorted(self.entries.items()):
+                line = json.dumps([path] + entry, separators=(',', ':'))
+                fp.write((line + '\n').encode('utf-8'))
+
+    def scan(self, *paths, **kwargs):
+        """
+        Add the sizes of the files in paths, recursing into directories.
+        """
+        minsize = kwargs.get('minsize', 1)
+        onerror = kwargs.get('onerror')
+
+        entries = self.entries
+
+        for path in _iterpaths(paths):
+            try:
+                size = os.lstat(path).st_size
+
+            except (IOError, OSError) as exc:
+                if onerror is not None:
+                    onerror(exc, path)
+                continue
+
+            if size >= minsize:
+                entries[path] = [size, None, None]
+
+    def sizes(self):
+        return set(entry[0] for entry in self.entries.values())
+
+    def keys(self, kind):
+        """
+        Get the (size, head) or (size, head, full) keys of the hashed files.
+        """
+        pos = 2 if kind == 'full' else 1
+        return set(tuple(entry[:pos + 1]) for entry in self.entries.values()
+                   if entry[pos] is not None)
+
+    def missing(self, kind, keys):
+        """
+        Get the paths lacking the kind digest among the ones matching keys.
+        """
+        pos = 2 if kind == 'full' else 1
+        return [path for path, entry in self.entries.items()
+                if entry[pos] is None and tuple(entry[:pos]) in keys]
+
+    def fill(self, kind, keys, onerror=None):
+        """
+        Compute the missing kind digests of the local files matching keys.
+        """
+        entries = self.entries
+
+        for path in self.missing(kind, keys):
+            entry = entries[path]
+
+            #: The head of a small file is its whole content
+            if kind == 'full' and entry[0] <= self.headsize:
+                entry[2] = entry[1]
+                continue
+
+            try:
+                if kind == 'full':
+                    digest = checksum(path, self.bufsize, self.hasher)
+                else:
+                    digest = _headsum(path, self.headsize, self.hasher)
+
+            except (IOError, OSError) as exc:
+                if onerror is not None:
+                    onerror(exc, path)
+                del entries[path]
+                continue
+
+            entry[2 if kind == 'full' else 1] = _hexdigest(digest)
+
+        return self
+
+
+def _colliding(keysets):
+    seen = set()
+    colliding = set()
+
+    for keys in keysets:
+        colliding.update(seen & keys)
+        seen.update(keys)
+
+    return colliding
+
+
+def diffindexes(indexes, fill=None, onerror=None):
+    """
+    Find the duplicate files across indexes, asking each one only for the
+    digests needed; fill(index, kind, keys) must compute them (on the host
+    where the index files are) and return the updated index.
+    """
+    indexes = list(indexes)
+
+    if len(set(index.hasher.name for index in indexes)) > 1:
+        raise ValueError('Indexes must use the same hash algorithm')
+
+    if len(set((index.headsize for index in indexes))) > 1:
+        raise ValueError('Indexes must use the same head size')
+
+    if fill is None:
+        def fill(index, kind, keys):
+            return index.fill(kind, keys, onerror)
+
+    sizes = _colliding(index.sizes() for index in indexes)
+    keys = set((size,) for size in sizes)
+
+    #: Partial digests first, then full ones for the still colliding
+    for kind in ('head', 'full'):
+        indexes = [fill(index, kind, keys) for index in indexes]
+        keys = _colliding(index.keys(kind) for index in indexes)
+
+    groups = defaultdict(list)
+
+    for index in indexes:
+        for path, entry in index.entries.items():
+            key = tuple(entry)
+            if key in keys:
+                groups[key].append((index.name, path))
+
+    dups = [tuple(sorted(dups)) for dups in groups.values()]
+    dups.sort(key=len, reverse=True)
+
+    return tuple(dups)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import gzip
+import json
+import os
+
+from collections import defaultdict, namedtuple
+
+from .core import filerule, purgeable, purgefiles
+from .index import _hexdigest
+from .structs import DupTable, FileInfo, FilterType, ResultInfo, ScanContext
+from .utils import gethasher
+
+
+_PlanEntry = namedtuple('PlanEntry', 'path keep size mtime inode digest')
+
+
+class PlanEntry(_PlanEntry):
+
+    __slots__ = []
+
+
+class PlanError(ValueError):
+    """
+    File changed since the plan was made
+    """
+    pass
+
+
+def _entry(fileinfo, keep, digest):
+    return PlanEntry(fileinfo.path, keep, fileinfo.size, fileinfo.mtime,
+                     fileinfo.inode, digest)
+
+
+class PurgePlan(object):
+    """
+    Keep/delete decisions of a scan, with the stat and digest of every file.
+    """
+    __slots__ = ['groups', 'hasher']
+
+    def __init__(self, groups=(), hasher=None):
+        self.groups = [tuple(PlanEntry(*entry) for entry in group)
+                       for group in groups]
+        self.hasher = gethasher(hasher)
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    @classmethod
+    def build(cls, duptable, refs=(), hasher=None, hashcache=None,
+              onerror=None):
+        """
+        Make the plan of the groups of a duplicate table.
+        """
+        hasher = gethasher(hasher)
+        _, rule = filerule(FilterType.HASH, hasher)
+        name = hasher.name
+
+        def digest(fileinfo):
+            value = None
+            if hashcache is not None:
+                value = hashcache.get(fileinfo, 'checksum', name)
+            if value is None:
+                value = rule(fileinfo)
+            return _hexdigest(value)
+
+        groups = []
+
+        for _, filelist in duptable:
+            duplist = set(map(id, purgeable(filelist, refs)))
+
+            try:
+                group = [_entry(fileinfo, id(fileinfo) not in duplist,
+                                digest(fileinfo))
+                         for fileinfo in filelist]
+
+            #: A group with an unreadable file is left out entirely
+            except (IOError, OSError) as exc:
+                if onerror is not None:
+                    onerror(exc, exc.filename)
+                continue
+
+            groups.append(group)
+
+        return cls(groups, hasher)
+
+    @classmethod
+    def load(cls, filename):
+        with gzip.open(filename, 'rb') as fp:
+            lines = iter(fp)
+            header = json.loads(next(lines).decode('utf-8'))
+
+            groups = [json.loads(line.decode('utf-8')) for line in lines]
+
+        return cls(groups, header['hasher'])
+
+    def save(self, filename):
+        header = {'hasher': self.hasher.name}
+
+        with gzip.open(filename, 'wb') as fp:
+            fp.write((json.dumps(header) + '\n').encode('utf-8'))
+
+            for group in self.groups:
+                line = json.dumps(group, separators=(',', ':'))
+                fp.write((line + '\n').encode('utf-8'))
+
+
+def _verify(entry, rule):
+    st = os.lstat(entry.path)
+    fileinfo = FileInfo(entry.path, entry.path, st)
+
+    if (fileinfo.size, fileinfo.mtime, fileinfo.inode) == (
+            entry.size, entry.mtime, entry.inode):
+        return fileinfo
+
+    #: Stat changed, trust the content only
+    if _hexdigest(rule(fileinfo)) != entry.digest:
+        raise PlanError('File changed since the plan was made: {0}'.format(
+            entry.path))
+
+    return fileinfo
+
+
+def _verifygroup(group, rule, errlist, onerror):
+    kept = []
+    purged = []
+    failed = []
+
+    for entry in group:
+        try:
+            fileinfo = _verify(entry, rule)
+
+        except (IOError, OSError, PlanError) as exc:
+            if onerror is not None:
+                onerror(exc, entry.path)
+            if not entry.keep:
+                failed.append(entry.path)
+            continue
+
+        (kept if entry.keep else purged).append(fileinfo)
+
+    #: Never purge a group whose kept copies are gone
+    if not kept:
+        failed.extend(fileinfo.path for fileinfo in purged)
+        purged = []
+
+    errlist.extend(failed)
+
+    return kept, purged
+
+
+def verifyplan(plan, onerror, progress):
+    """
+    Check again the files of a plan and get the ones safe to purge.
+    """
+    dupdict = defaultdict(list)
+    errlist = []
+    purgelist = []
+
+    context = ScanContext()
+    _, rule = filerule(FilterType.HASH, plan.hasher, cache=context.cache)
+
+    #: Groups are keyed by position, as two of them may share a digest
+    for pos, group in enumerate(plan):
+        kept, purged = _verifygroup(group, rule, errlist, onerror)
+
+        if purged:
+            dupdict[pos] = kept + purged
+            purgelist.extend(purged)
+
+        if progress is not None:
+            progress(len(group))
+
+    return DupTable(dupdict, []), purgelist, errlist
+
+
+def apply_plan(plan, trash=True, ondel=None, onerror=None, notify=None):
+    """
+    Purge the files planned for deletion still matching the plan.
+    """
+    if not isinstance(plan, PurgePlan):
+        plan = PurgePlan.load(plan)
+
+    if notify is None:
+        progress_v = progress_p = None
+    else:
+        def progress_v(value):
+            notify('verifying purge plan', value)
+
+        def progress_p(value):
+            notify('purging duplicates', value)
+
+    duptable, purgelist, errlist = verifyplan(plan, onerror, progress_v)
+
+    deldups, delerrors = purgefiles(purgelist, trash, ondel, onerror,
+                                    progress_p)
+    delerrors = sorted(delerrors + errlist)
+
+    if notify is not None:
+        notify('finalizing results')
+
+    return ResultInfo(duptable, deldups, [], delerrors)
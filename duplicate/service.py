@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import json
+import socket
+
+try:
+    from socketserver import StreamRequestHandler, ThreadingMixIn
+    from socketserver import UnixStreamServer
+except ImportError:
+    from SocketServer import StreamRequestHandler, ThreadingMixIn
+    from SocketServer import UnixStreamServer
+
+
+class _IndexHandler(StreamRequestHandler):
+
+    def __dispatch(self, request):
+        index = self.server.index
+        op = request.get('op')
+        path = request.get('path')
+
+        if op == 'lookup':
+            return {'paths': list(index.lookup(path))}
+
+        elif op == 'add':
+            index.add(path)
+            index.commit()
+
+        elif op == 'discard':
+            index.discard(path)
+            index.commit()
+
+        else:
+            raise ValueError('Unknown operation: {0}'.format(op))
+
+        return {}
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.__dispatch(json.loads(line.decode('utf-8')))
+
+            except Exception as exc:
+                response = {'error': str(exc)}
+
+            data = json.dumps(response) + '\n'
+            self.wfile.write(data.encode('utf-8'))
+            self.wfile.flush()
+
+
+class IndexServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Unix socket server answering lookups on a `DupIndex`.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, index):
+        UnixStreamServer.__init__(self, address, _IndexHandler)
+        self.index = index
+
+
+def serve(index, address):
+    """
+    Serve index on Unix socket address until interrupted.
+    """
+    server = IndexServer(address, index)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def query(address, op, path):
+    """
+    Send a request to the index server listening on address.
+    """
+    request = json.dumps({'op': op, 'path': path}) + '\n'
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        sock.sendall(request.encode('utf-8'))
+        fp = sock.makefile('rb')
+        try:
+            response = json.loads(fp.readline().decode('utf-8'))
+        finally:
+            fp.close()
+
+    finally:
+        sock.close()
+
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+
+    return tuple(response.get('paths', ()))
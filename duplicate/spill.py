@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import heapq
+import pickle
+
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+from tempfile import TemporaryFile
+
+
+_INFOSIZE = 320  #: bytes, rough size of a `FileInfo` but its path
+
+
+def _infosize(fileinfo):
+    return _INFOSIZE + len(fileinfo.path)
+
+
+def _readrun(fp):
+    fp.seek(0)
+    while True:
+        try:
+            yield pickle.load(fp)
+        except EOFError:
+            return
+
+
+class SpillDict(defaultdict):
+    """
+    Dict of file lists by key, spilled to sorted runs on disk
+    when past a memory budget (in bytes).
+    """
+    __slots__ = ['budget', 'runs', 'used']
+
+    def __init__(self, budget):
+        super(SpillDict, self).__init__(list)
+        self.budget = int(budget)
+        self.runs = []
+        self.used = 0
+
+    def account(self, filelist):
+        self.used += sum(map(_infosize, filelist))
+        if self.used > self.budget:
+            self.spill()
+
+    def spill(self):
+        if not self:
+            return
+
+        fp = TemporaryFile()
+        for item in sorted(self.items(), key=itemgetter(0)):
+            pickle.dump(item, fp, 2)
+
+        self.runs.append(fp)
+        self.clear()
+        self.used = 0
+
+    def groups(self):
+        """
+        Iterate the file lists by key, merged across the runs.
+        """
+        runs = [_readrun(fp) for fp in self.runs]
+        runs.append(iter(sorted(self.items(), key=itemgetter(0))))
+
+        for key, items in groupby(heapq.merge(*runs), itemgetter(0)):
+            filelist = []
+            for _, sublist in items:
+                filelist.extend(sublist)
+            yield key, filelist
+
+    def batches(self, keep=()):
+        """
+        Iterate dicts of the file lists to compare, each within budget
+        unless made of a single bigger list.
+        """
+        batch = {}
+        used = 0
+
+        for key, filelist in self.groups():
+            if len(filelist) < 2 and key not in keep:
+                continue
+
+            size = sum(map(_infosize, filelist))
+
+            if batch and used + size > self.budget:
+                yield batch
+                batch = {}
+                used = 0
+
+            batch[key] = filelist
+            used += size
+
+        if batch:
+            yield batch
+
+    def close(self):
+        for fp in self.runs:
+            fp.close()
+        self.runs = []
+        self.clear()
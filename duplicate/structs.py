@@ -3,14 +3,18 @@
 from __future__ import absolute_import
 
 import os
+import time
 
+from array import array
 from collections import namedtuple
 from enum import IntEnum
+from itertools import count
+from multiprocessing.pool import ThreadPool
 from operator import attrgetter
 from stat import S_IFMT
-from threading import RLock
+from threading import Event, Lock, RLock, Thread
 
-from .utils.fs import blkdevice, blksize
+from .utils.fs import blkdevice, blksize, calibrate, iosize
 
 # from ssd import is_ssd
 
@@ -36,40 +40,100 @@ class FilterType(IntEnum):
     RULE = 11
     HASH = 12
     BINARY = 13
+    CONTENT = 14
 
 
-_counter = 0  # NOTE: No multiprocessing proof.
+_counter = count(1)  # NOTE: No multiprocessing proof.
 
 # NOTE: blkdev is not a unique drive identifier...
-_CacheInfo = namedtuple('CacheInfo', 'blkdev blksize')
-_DupInfo = namedtuple('DupInfo', 'filter dups errors parent')
+_CacheInfo = namedtuple('CacheInfo', 'blkdev blksize iosize bufsize')
+_GroupInfo = namedtuple('GroupInfo', 'id filter key members')
 _FileInfo = namedtuple('FileInfo',
                        'index id path name dir mode inode dev mtime size')
+_ProgressInfo = namedtuple('ProgressInfo', 'done total rate eta')
 _ResultInfo = namedtuple('ResultInfo',
                          'dups deldups duperrors scanerrors delerrors')
 
 
 class Cache(object):
 
-    __slots__ = ['__dev', '__info', 'lock', 'maxlen']
+    __slots__ = ['__dev', '__info', 'lock', 'maxlen', 'shared']
 
     DEFAULT_MAXLEN = 128
 
-    def __init__(self, maxlen=DEFAULT_MAXLEN):
+    #: bytes
+    TUNE_BUFSIZES = tuple(64 << 10 << n for n in range(8))
+
+    def __init__(self, maxlen=DEFAULT_MAXLEN, shared=None):
         self.__dev = {}
         self.__info = {}
         self.maxlen = int(maxlen)
         self.lock = RLock()
+        self.shared = shared
+
+    def __share(self, dev, value):
+        #: Lookups and calibrations are written back for the next scans
+        shared = self.shared
+        if shared is None:
+            return
+
+        with shared.lock:
+            if dev not in shared.__dev and len(shared.__dev) >= shared.maxlen:
+                return
+            shared.__dev[dev] = value.blkdev
+            if value.bufsize is not None or value.blkdev not in shared.__info:
+                shared.__info[value.blkdev] = value
 
     def get(self, fileinfo):
-        blockdevice = self.__dev.setdefault(
-            fileinfo.dev,
-            blkdevice(fileinfo.path))
-        value = self.__info.setdefault(
-            blockdevice,
-            _CacheInfo(blockdevice, blksize(fileinfo.path)))
+        shared = self.shared
+        missed = False
+
+        try:
+            blockdevice = self.__dev[fileinfo.dev]
+        except KeyError:
+            blockdevice = None
+            if shared is not None:
+                blockdevice = shared.__dev.get(fileinfo.dev)
+            if blockdevice is None:
+                blockdevice = blkdevice(fileinfo.path)
+                missed = True
+            self.__dev[fileinfo.dev] = blockdevice
+
+        try:
+            value = self.__info[blockdevice]
+        except KeyError:
+            value = None
+            if shared is not None:
+                value = shared.__info.get(blockdevice)
+            if value is None:
+                value = _CacheInfo(blockdevice, blksize(fileinfo.path),
+                                   iosize(fileinfo.path, blockdevice), None)
+                missed = True
+            self.__info[blockdevice] = value
+
+        if missed:
+            self.__share(fileinfo.dev, value)
+
         return value
 
+    def tune(self, fileinfo):
+        value = self.get(fileinfo)
+
+        if value.bufsize is None:
+            bufsizes = [size for size in self.TUNE_BUFSIZES
+                        if size >= value.iosize] or [value.iosize]
+            bufsize = calibrate(fileinfo.path, bufsizes)
+
+            #: Retry with the next file, if too small to be sampled
+            if bufsize is None:
+                return max(value.iosize, value.blksize)
+
+            value = value._replace(bufsize=bufsize)
+            self.__info[value.blkdev] = value
+            self.__share(fileinfo.dev, value)
+
+        return value.bufsize
+
     def clear(self):
         if self.lock.locked():
             return False
@@ -86,39 +150,242 @@ class Cache(object):
             self.clear()
 
 
-class DupInfo(_DupInfo):
+#: Device cache shared by the scans of the process
+CACHE = Cache()
+
+
+class ScanContext(object):
+    """
+    State of a single scan: device cache, file counter and thread pool.
+    """
+    __slots__ = ['cache', 'counter', 'pool', 'progress', 'workers']
+
+    def __init__(self, shared=CACHE, workers=None):
+        self.cache = Cache(shared=shared)
+        self.counter = count(1)
+        self.workers = workers
+        self.pool = None
+        self.progress = None
+
+    def getpool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class ProgressInfo(_ProgressInfo):
+
+    __slots__ = []
+
+
+class Progress(object):
+    """
+    Work done by the running stage, notified by a background thread
+    at most once per interval.
+    """
+    __slots__ = ['__event', '__lock', '__thread', 'done', 'interval',
+                 'message', 'notify', 'started', 'total']
+
+    DEFAULT_INTERVAL = 1.0  #: seconds
+
+    def __init__(self, notify, interval=DEFAULT_INTERVAL):
+        self.__event = Event()
+        self.__lock = Lock()
+        self.__thread = None
+        self.notify = notify
+        self.interval = float(interval)
+        self.message = None
+        self.started = None
+        self.total = None
+        self.done = 0
+
+    def begin(self, message, total=None):
+        #: Notified by the background thread only, never half switched
+        with self.__lock:
+            self.started = time.time()
+            self.total = total
+            self.done = 0
+            self.message = message
+
+    def plan(self, total):
+        self.total = total
+
+    def advance(self, value):
+        self.done += value
+
+    def info(self):
+        done = self.done
+        total = self.total
+
+        elapsed = time.time() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if total is not None and rate:
+            eta = max(total - done, 0) / rate
+
+        return ProgressInfo(done, total, rate, eta)
+
+    def report(self):
+        with self.__lock:
+            if self.message is not None:
+                self.notify(self.message, self.info())
+
+    def __run(self):
+        while not self.__event.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self.__event.clear()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.report()
+
+
+class Budget(object):
+    """
+    Time and read limits of the filtering, with the groups left unverified.
+    """
+    __slots__ = ['deadline', 'deferred', 'maxread', 'readsize']
+
+    def __init__(self, maxtime=None, maxread=None):
+        self.deadline = time.time() + maxtime if maxtime else None
+        self.maxread = int(maxread or 0)
+        self.readsize = 0
+        self.deferred = []
+
+    def charge(self, nbytes):
+        self.readsize += nbytes
+
+    def exhausted(self):
+        if self.maxread and self.readsize >= self.maxread:
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
+
+
+class GroupInfo(_GroupInfo):
 
     __slots__ = []
 
-    def __new__(cls, filtertype, dups, errors, parentobj=None, parentkey=None):
-        parent = (parentobj, parentkey) if parentobj and parentkey else None
 
-        new = super(DupInfo, cls).__new__
-        inst = new(cls, filtertype, dups, errors, parent)
+class DupTable(object):
+    """
+    Flat table of duplicate groups, refined in place by each filter.
+    """
+    __slots__ = ['__files', '__groups', '__holes', 'errors']
+
+    def __init__(self, dupdict, errlist):
+        self.__files = []
+        self.__groups = []
+        self.__holes = 0
+        self.errors = []
+
+        self.__extend(FilterType.ID, dupdict, errlist)
+
+    def __len__(self):
+        return len(self.__groups) - self.__holes
 
-        if parent:
-            parentobj.dups[parentkey] = inst
+    def __iter__(self):
+        if self.__holes:
+            self.__compact()
 
-        return inst
+        files = self.__files
+        groups = self.__groups
 
-    def __init__(self, *args, **kwargs):
-        super(DupInfo, self).__init__(*args, **kwargs)
-        self._filter()
+        #: Groups appended while iterating are left to the next stage
+        for pos in range(len(groups)):
+            group = groups[pos]
+            if group is None:
+                continue
+            yield group, [files[i] for i in group.members]
+
+    def __compact(self):
+        groups = [group for group in self.__groups if group is not None]
+        self.__groups = [group._replace(id=pos)
+                         for pos, group in enumerate(groups)]
+        self.__holes = 0
+
+    def __append(self, fltrtype, key, members):
+        groups = self.__groups
+        groups.append(GroupInfo(len(groups), fltrtype, key, members))
+
+    def __extend(self, fltrtype, dupdict, errlist):
+        files = self.__files
+
+        for key, filelist in dupdict.items():
+            if len(filelist) < 2:
+                continue
+
+            start = len(files)
+            files.extend(filelist)
+            members = array('l', range(start, len(files)))
+
+            self.__append(fltrtype, key, members)
+
+        if errlist:
+            self.errors.append(errlist)
+
+    def update(self, duptable):
+        """
+        Append the groups and the errors of another table.
+        """
+        files = self.__files
 
-    def _filter(self, delkey=None):
-        dupdict = self.dups
+        for group, filelist in duptable:
+            start = len(files)
+            files.extend(filelist)
+            members = array('l', range(start, len(files)))
+
+            self.__append(group.filter, group.key, members)
+
+        self.errors.extend(duptable.errors)
+
+    def prune(self, func):
+        """
+        Drop the groups whose files don't satisfy func.
+        """
+        groups = self.__groups
+        files = self.__files
+
+        for pos, group in enumerate(groups):
+            if group is None:
+                continue
+            if func([files[i] for i in group.members]):
+                continue
+            groups[pos] = None
+            self.__holes += 1
+
+    def split(self, group, fltrtype, dupdict, errlist, filelist):
+        """
+        Replace group with the sub-groups of its files found by a filter.
+        """
+        self.__groups[group.id] = None
+        self.__holes += 1
+
+        index = dict(zip(map(id, filelist), group.members))
+
+        for key, sublist in dupdict.items():
+            if len(sublist) < 2:
+                continue
 
-        if delkey is None:
-            for key, value in dupdict.items():
-                if len(value) > 1:
-                    continue
-                dupdict.pop(key)
-        else:
-            dupdict.pop(delkey, None)
+            members = array('l', (index[id(f)] for f in sublist))
+            self.__append(fltrtype, key, members)
 
-        if not dupdict and not self.errors and self.parent:
-            parentobj, parentkey = self.parent
-            parentobj._filter(parentkey)
+        if errlist:
+            self.errors.append(errlist)
 
 
 class FileInfo(_FileInfo):
@@ -126,7 +393,7 @@ class FileInfo(_FileInfo):
     __slots__ = []
 
     @classmethod
-    def __new(cls, name, path, st):
+    def __new(cls, name, path, st, counter):
 
         dirname, filename = os.path.split(name)
         mode = st.st_mode
@@ -140,77 +407,98 @@ class FileInfo(_FileInfo):
         size = st.st_size
         fileid = (ifmt, size)
 
-        global _counter
-        _counter += 1
+        #: Thread-safe, as `next` on a count holds the GIL
+        index = next(_counter if counter is None else counter)
 
         new = super(FileInfo, cls).__new__
-        return new(cls, _counter, fileid, path, filename, dirname, mode, inode,
+        return new(cls, index, fileid, path, filename, dirname, mode, inode,
                    dev, mtime, size)
 
-    def __new__(cls, name, path=None, st=None):
+    def __new__(cls, name, path=None, st=None, counter=None):
         if path is None:
             path = os.path.abspath(name)
 
         if st is None:
             st = os.lstat(name)
 
-        return cls.__new(name, path, st)
+        return cls.__new(name, path, st, counter)
 
+    def __reduce__(self):
+        return _fileinfo, (tuple(self),)
 
-class ResultInfo(_ResultInfo):
 
-    __slots__ = []
+def _fileinfo(fields):
+    return _FileInfo.__new__(FileInfo, *fields)
 
-    @staticmethod
-    def __iter_dups(dupinfo):
-        for key, value in dupinfo.dups.items():
-            if isinstance(value, DupInfo):
-                dups_it = ResultInfo.__iter_dups(value)
-                for subobj, subkey, subvalue in dups_it:
-                    yield subobj, subkey, subvalue
-            else:
-                yield dupinfo, key, value
 
-    @staticmethod
-    def __iter_errors(dupinfo):
-        yield dupinfo.errors
+class ResultInfo(_ResultInfo):
 
-        for value in dupinfo.dups.values():
-            if not isinstance(value, DupInfo):
-                continue
-            for errlist in ResultInfo.__iter_errors(value):
-                yield errlist
+    __slots__ = []
 
     @staticmethod
-    def __parse_dups(dupinfo):
+    def __parse_dups(duptable):
         sort_fn = attrgetter('index', 'path')
-        dups_it = ResultInfo.__iter_dups(dupinfo)
 
         dups = [tuple(sorted(duplist, key=sort_fn))
-                for _, _, duplist in dups_it if duplist]
+                for _, duplist in duptable if duplist]
 
         dups.sort(key=len, reverse=True)
         return tuple(dups)
 
     @staticmethod
-    def __parse_errors(dupinfo):
+    def __parse_errors(duptable):
         sort_fn = attrgetter('index', 'path')
-        errors_it = ResultInfo.__iter_errors(dupinfo)
 
         errors = [tuple(sorted(errlist, key=sort_fn))
-                  for errlist in errors_it if errlist]
+                  for errlist in duptable.errors if errlist]
 
         errors.sort(key=len, reverse=True)
         return tuple(errors)
 
-    def __new__(cls, dupinfo, delduplist, scnerrlist, delerrors):
-        dups = cls.__parse_dups(dupinfo)
+    def __new__(cls, duptable, delduplist, scnerrlist, delerrors):
+        dups = cls.__parse_dups(duptable)
 
         deldups = tuple(delduplist)
 
-        duperrors = cls.__parse_errors(dupinfo)
+        duperrors = cls.__parse_errors(duptable)
         scanerrors = tuple(scnerrlist)
         delerrors = tuple(delerrors)
 
         new = super(ResultInfo, cls).__new__
         return new(cls, dups, deldups, duperrors, scanerrors, delerrors)
+
+
+class LazyResult(object):
+    """
+    Duplicate result class, iterating its groups on demand.
+    """
+    __slots__ = ['__duptable', 'deldups', 'delerrors', 'scanerrors']
+
+    def __init__(self, duptable, delduplist, scnerrlist, delerrors):
+        self.__duptable = duptable
+        self.deldups = tuple(delduplist)
+        self.scanerrors = tuple(scnerrlist)
+        self.delerrors = tuple(delerrors)
+
+    def __len__(self):
+        return len(self.__duptable)
+
+    @property
+    def dups(self):
+        sort_fn = attrgetter('index', 'path')
+
+        for _, duplist in self.__duptable:
+            if duplist:
+                yield tuple(sorted(duplist, key=sort_fn))
+
+    @property
+    def duperrors(self):
+        sort_fn = attrgetter('index', 'path')
+
+        for errlist in self.__duptable.errors:
+            if errlist:
+                yield tuple(sorted(errlist, key=sort_fn))
+
+    def materialize(self):
+        return ResultInfo(self.__duptable, self.deldups, self.scanerrors,
+                          self.delerrors)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import os
+
+from collections import defaultdict
+from stat import S_IFMT
+
+from .core import cachedrule, filerule
+from .structs import FileInfo, FilterType, ScanContext, SkipException
+from .utils import from_iterable, gethasher, hashsum
+from .utils.fs import fullpath, listentries, remove
+
+
+class _Node(object):
+
+    __slots__ = ['digest', 'dirs', 'failed', 'files', 'links', 'others',
+                 'path', 'shape', 'size']
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = []
+        self.files = []
+        self.links = []
+        self.others = []
+        self.size = 0
+        self.failed = False
+        self.shape = None
+        self.digest = None
+
+
+def _treesum(items, hasher):
+    data = repr(sorted(items)).encode('utf-8')
+    return hashsum(data, hasher)
+
+
+def _listnode(node, onerror, followlinks):
+    def scanerror(exc):
+        node.failed = True
+        if onerror is not None:
+            onerror(exc, node.path)
+
+    dirs, files, links, others = listentries(node.path, scanerror,
+                                             followlinks)
+
+    for entry in files:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except (IOError, OSError) as exc:
+            scanerror(exc)
+            continue
+
+        node.files.append((entry.name, entry.path, st))
+        node.size += st.st_size
+
+    for entry in links:
+        try:
+            node.links.append((entry.name, os.readlink(entry.path)))
+        except (IOError, OSError) as exc:
+            scanerror(exc)
+
+    #: Fifos, sockets and devices count for their type only
+    for entry in others:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except (IOError, OSError) as exc:
+            scanerror(exc)
+            continue
+
+        node.others.append((entry.name, (S_IFMT(st.st_mode), st.st_rdev)))
+
+    children = [_Node(entry.path) for entry in dirs]
+    node.dirs.extend(zip((entry.name for entry in dirs), children))
+
+    return children
+
+
+def _scantree(path, onerror, followlinks, seen):
+    """
+    List the directories of a tree, parents before children.
+    """
+    nodes = []
+    stack = [_Node(fullpath(path))]
+
+    while stack:
+        node = stack.pop()
+
+        realpath = fullpath(node.path)
+        if realpath in seen:
+            node.failed = True
+            continue
+        seen.add(realpath)
+
+        nodes.append(node)
+        stack.extend(_listnode(node, onerror, followlinks))
+
+    #: Bottom-up, a directory is known once all its children are
+    for node in reversed(nodes):
+        for _, child in node.dirs:
+            node.size += child.size
+            node.failed = node.failed or child.failed
+
+        items = [('f', name, st.st_size) for name, _, st in node.files]
+        items.extend(('l', name, link) for name, link in node.links)
+        items.extend(('s', name, kind) for name, kind in node.others)
+        items.extend(('d', name, child.shape) for name, child in node.dirs)
+        node.shape = _treesum(items, None)
+
+    return nodes
+
+
+def _subtree(node):
+    nodes = []
+    stack = [node]
+
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(child for _, child in node.dirs)
+
+    return nodes
+
+
+def _merkle(node, rule, hasher):
+    for subnode in reversed(_subtree(node)):
+        if subnode.digest is not None:
+            continue
+
+        items = [('f', name, rule(FileInfo(filepath, filepath, st)))
+                 for name, filepath, st in subnode.files]
+        items.extend(('l', name, link) for name, link in subnode.links)
+        items.extend(('s', name, kind) for name, kind in subnode.others)
+        items.extend(('d', name, child.digest)
+                     for name, child in subnode.dirs)
+
+        subnode.digest = _treesum(items, hasher)
+
+    return node.digest
+
+
+def _shapegroups(nodes, minsize):
+    groups = defaultdict(list)
+
+    for node in nodes:
+        if node.failed or node.size < minsize:
+            continue
+        groups[node.shape].append(node)
+
+    groups = [group for group in groups.values() if len(group) > 1]
+    groups.sort(key=lambda group: group[0].size, reverse=True)
+
+    return groups
+
+
+def _treegroups(shapegroups, rule, hasher, onerror):
+    covered = set()
+    kept = set()
+    treegroups = []
+
+    # NOTE: Keep the copies lying in trees already kept, then the firsts
+    def sort_fn(node):
+        return id(node) not in kept, node.path
+
+    for group in shapegroups:
+        #: Already proven by a matching parent
+        nodes = [node for node in group if id(node) not in covered]
+        if len(nodes) < 2:
+            continue
+
+        digests = defaultdict(list)
+
+        for node in nodes:
+            try:
+                digests[_merkle(node, rule, hasher)].append(node)
+
+            except (IOError, OSError) as exc:
+                if onerror is not None:
+                    onerror(exc, exc.filename)
+
+        for subgroup in digests.values():
+            if len(subgroup) < 2:
+                continue
+
+            subgroup.sort(key=sort_fn)
+            treegroups.append(tuple(node.path for node in subgroup))
+
+            keeper = subgroup[0]
+            kept.update(map(id, _subtree(keeper)))
+
+            #: Stop descending into the copies
+            for node in subgroup[1:]:
+                covered.update(map(id, _subtree(node)))
+
+    return tuple(treegroups)
+
+
+@from_iterable
+def findtrees(*paths, **kwargs):
+    """
+    Find the identical directory trees, the largest first.
+    """
+    minsize = kwargs.pop('minsize', 1)
+    followlinks = kwargs.pop('followlinks', False)
+    hasher = gethasher(kwargs.pop('hasher', None))
+    hashcache = kwargs.pop('hashcache', None)
+    onerror = kwargs.pop('onerror', None)
+
+    if not paths:
+        raise ValueError('Paths must not be empty')
+
+    seen = set()
+    nodes = []
+    for path in paths:
+        nodes.extend(_scantree(path, onerror, followlinks, seen))
+
+    #: Cheap shapes (names and sizes) first, contents only on collision
+    shapegroups = _shapegroups(nodes, minsize)
+
+    context = ScanContext()
+
+    _, rule = filerule(FilterType.HASH, hasher, cache=context.cache)
+    rule = cachedrule(rule, 'checksum', hasher, hashcache)
+
+    try:
+        return _treegroups(shapegroups, rule, hasher, onerror)
+
+    finally:
+        if hashcache is not None:
+            hashcache.commit()
+
+
+@from_iterable
+def purgetrees(*paths, **kwargs):
+    """
+    Remove the copies of the identical directory trees.
+    """
+    trash = kwargs.pop('trash', True)
+    ondel = kwargs.pop('ondel', None)
+    onerror = kwargs.get('onerror')
+
+    deldirs = []
+    delerrors = []
+
+    for group in findtrees(*paths, **kwargs):
+        for dirpath in group[1:]:
+            #: Gone with a parent copy
+            if not os.path.lexists(dirpath):
+                continue
+
+            if ondel is not None:
+                try:
+                    ondel(dirpath)
+                except SkipException:
+                    continue
+
+            try:
+                remove(dirpath, trash)
+
+            except Exception as exc:
+                if onerror is not None:
+                    onerror(exc, dirpath)
+                delerrors.append(dirpath)
+
+            else:
+                deldirs.append(dirpath)
+
+    return tuple(deldirs), tuple(delerrors)
@@ -3,4 +3,5 @@
 from __future__ import absolute_import
 
 from . import fs
+from .hashers import gethasher, hashsum
 from .init import *
@@ -2,19 +2,21 @@
 
 from __future__ import absolute_import
 
+import errno
 import os
 import shutil
+import struct
 
 from contextlib import contextmanager
 from os.path import (lexists, expanduser, isfile, islink, ismount,
                      realpath)
 from stat import S_ISDIR, S_ISLNK, S_ISREG
+from timeit import default_timer as timer
 
 import psutil
 import send2trash
-import xxhash
 
-from ..init import is_os64
+from ..hashers import gethasher
 
 try:
     import directio
@@ -27,9 +29,6 @@ except ImportError:
     from scandir import scandir
 
 
-_xxhash_xxh = xxhash.xxh64 if is_os64 else xxhash.xxh32
-
-
 def fullpath(path):
     return realpath(expanduser(path))
 
@@ -42,6 +41,14 @@ def fsdecode(path):
     return upath
 
 
+def fsencode(path):
+    try:
+        bpath = os.fsencode(path)
+    except AttributeError:
+        bpath = path
+    return bpath
+
+
 def _stat(path):
     try:
         mode = os.lstat(path).st_mode
@@ -99,10 +106,14 @@ def _scaniter(iterable, onerror):
             return
 
 
-def _scandir(path, onerror, followlinks):
+def listentries(path, onerror=None, followlinks=False):
+    """
+    List the sub-directories, files, links and special files of a directory.
+    """
     dirs = []
     files = []
     links = []
+    others = []
 
     try:
         scandir_it = scandir(path)
@@ -110,7 +121,7 @@ def _scandir(path, onerror, followlinks):
     except (IOError, OSError) as exc:
         if onerror is not None:
             onerror(exc)
-        return
+        return dirs, files, links, others
 
     try:
         for entry in _scaniter(scandir_it, onerror):
@@ -118,13 +129,17 @@ def _scandir(path, onerror, followlinks):
             if entry.is_file(follow_symlinks=False):
                 files.append(entry)
 
-            elif entry.is_dir(followlinks):
+            elif entry.is_dir(follow_symlinks=followlinks):
                 dirs.append(entry)
 
-            elif entry.is_file():
+            #: Links to directories or dangling ones too
+            elif entry.is_symlink():
                 links.append(entry)
 
-        return dirs, files, links
+            else:
+                others.append(entry)
+
+        return dirs, files, links, others
 
     finally:
         try:
@@ -133,6 +148,13 @@ def _scandir(path, onerror, followlinks):
             pass
 
 
+def _scandir(path, onerror, followlinks):
+    dirs, files, links, _ = listentries(path, onerror, followlinks)
+
+    #: Only the links to files are scanned
+    return dirs, files, [entry for entry in links if entry.is_file()]
+
+
 def _walk(seen, path, onerror, followlinks):
     if path in seen:
         return
@@ -177,12 +199,19 @@ def blkdevice(path):
     if os.name == 'nt':
         mount = mount.upper()
 
-    device = next(dp.device for dp in partitions if dp.mountpoin == mount)
+    device = next(dp.device for dp in partitions if dp.mountpoint == mount)
     block = device.rsplit('/', 1)[-1]
 
     return block
 
 
+def directread():
+    """
+    Whether reads asked to be direct bypass the page cache.
+    """
+    return directio is not None and hasattr(os, 'O_DIRECT')
+
+
 def _readflags(sequential, direct):
     flags = os.O_RDONLY
     try:
@@ -195,8 +224,8 @@ def _readflags(sequential, direct):
 
     try:
         if direct:
-            flags |= os.O_DIRECT
             read = directio.read
+            flags |= os.O_DIRECT
         else:
             raise AttributeError
 
@@ -246,65 +275,465 @@ def readopen(filename, sequential=None, direct=False):
         os.close(fd)
 
 
-def signature(filename):
+def prefetch(filename, offset=0, length=0):
+    """
+    Advise the kernel to read ahead a region of file.
+    """
+    try:
+        advise = os.posix_fadvise
+        willneed = os.POSIX_FADV_WILLNEED
+
+    except AttributeError:
+        return False
+
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        advise(fd, offset, length, willneed)
+
+    finally:
+        os.close(fd)
+
+    return True
+
+
+def _droppages(fd, offset, length):
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except AttributeError:
+        pass
+
+
+def calibrate(filename, bufsizes, chunksize=4 << 20):
+    """
+    Time sequential reads of file with each buffer size (in bytes)
+    and return the fastest one, or `None` if file is too small.
+    """
+    spans = [max(chunksize, bufsize) for bufsize in bufsizes]
+    if os.path.getsize(filename) < sum(spans):
+        return None
+
+    rates = []
+    offset = 0
+
+    with readopen(filename, sequential=True, direct=True) as (read, fd):
+        for bufsize, span in zip(bufsizes, spans):
+            #: Read a fresh region each time, not the page cache
+            _droppages(fd, offset, span)
+            os.lseek(fd, offset, os.SEEK_SET)
+
+            left = span
+            start = timer()
+            while left > 0 and read(bufsize):
+                left -= bufsize
+            elapsed = timer() - start
+
+            rates.append((span / max(elapsed, 1e-9), bufsize))
+            offset += span
+
+    return max(rates)[1]
+
+
+def signature(filename, hasher=None, counter=None):
+    hasher = gethasher(hasher)
+    x = hasher.new()
+
     with readopen(filename) as (read, _):
         data = read(261)
-    return _xxhash_xxh(data).hexdigest()
+        x.update(data)
+
+    if counter is not None:
+        counter.done += len(data)
+
+    return hasher.digest(x)
 
 
-def _chunksum(fd, read, size, bufsizes, whence):
+def _chunksum(fd, read, size, bufsizes, whence, hasher, counter=None):
     buf0, buf1 = bufsizes
     offset, how = whence
 
-    x = _xxhash_xxh()
+    x = hasher.new()
     update = x.update
 
     if offset:
         os.lseek(fd, offset, how)
 
-    left = size
-    data = read(buf0)
-    while left and data:
-        update(data)
-        left -= buf0
+    left = size - buf1
+    while left > 0:
         data = read(buf0)
+        if not data:
+            break
+        update(data)
+        left -= len(data)
+
+        #: Bytes read are added up to the `done` attribute of counter
+        if counter is not None:
+            counter.done += len(data)
 
     if buf1:
         data = read(buf1)
         update(data)
 
-    return x.hexdigest()
+        if counter is not None:
+            counter.done += len(data)
 
+    return hasher.digest(x)
 
-def sidesum(filename, chksize, bufsize, offset=0):
+
+def _sidebufsizes(chksize, bufsize):
     if bufsize < chksize:
-        bufsizes = (bufsize, chksize % bufsize)
-    else:
-        bufsizes = (chksize, 0)
+        return bufsize, chksize % bufsize
+    return chksize, 0
+
+
+def headsum(filename, chksize, bufsize, offset=0, hasher=None,
+            counter=None):
+    hasher = gethasher(hasher)
+    bufsizes = _sidebufsizes(chksize, bufsize)
+
+    with readopen(filename, sequential=False, direct=True) as (read, fd):
+        whence = (abs(offset), os.SEEK_SET)
+        return _chunksum(fd, read, chksize, bufsizes, whence, hasher,
+                         counter)
+
+
+def tailsum(filename, chksize, bufsize, offset=0, hasher=None,
+            counter=None):
+    hasher = gethasher(hasher)
+    bufsizes = _sidebufsizes(chksize, bufsize)
+
+    with readopen(filename, sequential=False, direct=True) as (read, fd):
+        whence = (-chksize - abs(offset), os.SEEK_END)
+        return _chunksum(fd, read, chksize, bufsizes, whence, hasher,
+                         counter)
+
+
+def sidesum(filename, chksize, bufsize, offset=0, hasher=None,
+            counter=None):
+    hasher = gethasher(hasher)
+    bufsizes = _sidebufsizes(chksize, bufsize)
 
     offset = abs(offset)
 
     with readopen(filename, sequential=False, direct=True) as (read, fd):
         whence = (offset, os.SEEK_SET)
-        header = _chunksum(fd, read, chksize, bufsizes, whence)
+        header = _chunksum(fd, read, chksize, bufsizes, whence, hasher,
+                           counter)
 
         whence = (-chksize - offset, os.SEEK_END)
-        footer = _chunksum(fd, read, chksize, bufsizes, whence)
+        footer = _chunksum(fd, read, chksize, bufsizes, whence, hasher,
+                           counter)
 
     return header, footer
 
 
-def checksum(filename, bufsize):
-    x = _xxhash_xxh()
+def checksum(filename, bufsize, hasher=None, counter=None):
+    hasher = gethasher(hasher)
+    x = hasher.new()
     update = x.update
 
     with readopen(filename, sequential=True, direct=True) as (read, _):
         data = read(bufsize)
         while data:
             update(data)
+            if counter is not None:
+                counter.done += len(data)
             data = read(bufsize)
 
-    return x.hexdigest()
+    return hasher.digest(x)
+
+
+_SPARSEBLOCK = 4 << 10  #: bytes
+_ZEROBLOCK = b'\0' * _SPARSEBLOCK
+
+
+def dataextents(fd, size):
+    """
+    Iterate the `(start, end)` offsets of the data regions of an open file,
+    skipping its holes. The whole file is one region where unsupported.
+    """
+    try:
+        seek_data = os.SEEK_DATA
+        seek_hole = os.SEEK_HOLE
+
+    except AttributeError:
+        if size:
+            yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, seek_data)
+
+        except OSError as exc:
+            #: No more data up to the end of file
+            if exc.errno == errno.ENXIO:
+                return
+            if exc.errno != errno.EINVAL:
+                raise
+            yield offset, size
+            return
+
+        end = min(size, os.lseek(fd, start, seek_hole))
+        yield start, end
+        offset = end
+
+
+def _addzeros(zeroruns, first, count):
+    if zeroruns and sum(zeroruns[-1]) == first:
+        zeroruns[-1][1] += count
+    else:
+        zeroruns.append([first, count])
+
+
+def _sparsefold(data, offset, update, zeroruns, zeros):
+    block = _SPARSEBLOCK
+    length = len(data)
+
+    if data == zeros or data == zeros[:length]:
+        _addzeros(zeroruns, offset // block, -(-length // block))
+        return
+
+    view = memoryview(data)
+    start = pos = 0
+    tail = length - length % block
+
+    #: Feed the runs of data blocks, note the zero ones by position
+    while True:
+        pos = data.find(_ZEROBLOCK, pos)
+        if pos < 0:
+            break
+
+        pos += -pos % block
+        if pos >= tail:
+            break
+
+        if view[pos:pos + block] != _ZEROBLOCK:
+            pos += 1
+            continue
+
+        if pos > start:
+            update(view[start:pos])
+        _addzeros(zeroruns, (offset + pos) // block, 1)
+        start = pos = pos + block
+
+    if start <= tail < length and data.count(b'\0', tail) == length - tail:
+        update(view[start:tail])
+        _addzeros(zeroruns, (offset + tail) // block, 1)
+        start = length
+
+    if start < length:
+        update(view[start:])
+
+
+def sparsesum(filename, bufsize, hasher=None, counter=None):
+    """
+    Hash the data regions of file only, folding the position of every zero
+    block (either a hole or written zeroes) into the digest, so that a sparse
+    file and its dense copy hash the same.
+    """
+    hasher = gethasher(hasher)
+    x = hasher.new()
+    update = x.update
+
+    block = _SPARSEBLOCK
+    bufsize = max(block, bufsize - bufsize % block)
+    zeros = b'\0' * bufsize
+    zeroruns = []
+
+    with readopen(filename, sequential=True) as (read, fd):
+        size = os.fstat(fd).st_size
+        last = 0
+
+        for start, end in dataextents(fd, size):
+            #: Align to whole blocks, holes included
+            start = max(last, start - start % block)
+            end = min(size, -(-end // block) * block)
+
+            if start > last:
+                _addzeros(zeroruns, last // block, (start - last) // block)
+
+            os.lseek(fd, start, os.SEEK_SET)
+
+            offset = start
+            while offset < end:
+                data = read(min(bufsize, end - offset))
+                if not data:
+                    break
+                _sparsefold(data, offset, update, zeroruns, zeros)
+                offset += len(data)
+
+                if counter is not None:
+                    counter.done += len(data)
+
+            last = offset
+
+        if last < size:
+            _addzeros(zeroruns, last // block, -(-(size - last) // block))
+
+    y = hasher.new()
+    y.update(struct.pack('<Q', size))
+    for first, count in zeroruns:
+        y.update(struct.pack('<QQ', first, count))
+    y.update(repr(hasher.digest(x)).encode('ascii'))
+
+    return hasher.digest(y)
+
+
+def _mergeextents(extents):
+    merged = []
+
+    for start, end in sorted(extents):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+def filecmp(filename1, filename2, bufsize, counter=None):
+    """
+    Compare the content of two files.
+    """
+    with readopen(filename1, sequential=True) as (read1, fd1):
+        with readopen(filename2, sequential=True) as (read2, fd2):
+            if os.fstat(fd1).st_size != os.fstat(fd2).st_size:
+                return False
+
+            while True:
+                data = read1(bufsize)
+                if data != read2(bufsize):
+                    return False
+                if not data:
+                    return True
+
+                if counter is not None:
+                    counter.done += 2 * len(data)
+
+
+def hashcmp(filename1, filename2, bufsize, hasher=None, counter=None):
+    """
+    Compare the content of two files, hashing it on the way.
+    Return the digest of the content if equal, otherwise `None`.
+    """
+    hasher = gethasher(hasher)
+    x = hasher.new()
+    update = x.update
+
+    with readopen(filename1, sequential=True) as (read1, fd1):
+        with readopen(filename2, sequential=True) as (read2, fd2):
+            if os.fstat(fd1).st_size != os.fstat(fd2).st_size:
+                return None
+
+            while True:
+                data = read1(bufsize)
+                if data != read2(bufsize):
+                    return None
+                if not data:
+                    return hasher.digest(x)
+                update(data)
+
+                if counter is not None:
+                    counter.done += 2 * len(data)
+
+
+def sparsecmp(filename1, filename2, bufsize, counter=None):
+    """
+    Compare the content of two files, reading only the regions
+    that are data in at least one of them.
+    """
+    with readopen(filename1, sequential=True) as (read1, fd1):
+        with readopen(filename2, sequential=True) as (read2, fd2):
+            size = os.fstat(fd1).st_size
+
+            if os.fstat(fd2).st_size != size:
+                return False
+
+            extents = list(dataextents(fd1, size))
+            extents.extend(dataextents(fd2, size))
+
+            for start, end in _mergeextents(extents):
+                os.lseek(fd1, start, os.SEEK_SET)
+                os.lseek(fd2, start, os.SEEK_SET)
+
+                left = end - start
+                while left > 0:
+                    length = min(bufsize, left)
+                    data = read1(length)
+                    if data != read2(length):
+                        return False
+                    if not data:
+                        break
+                    left -= len(data)
+
+                    if counter is not None:
+                        counter.done += 2 * len(data)
+
+    return True
+
+
+def blocksums(filename, blocksize, bufsize, hasher=None, blocks=(), size=0,
+              counter=None):
+    """
+    Hash file in blocks of blocksize, resuming from the block digests of its
+    first size bytes. Return the list of block digests, or `None` if
+    the last of the given blocks doesn't match the file anymore.
+    """
+    hasher = gethasher(hasher)
+
+    count, tail = divmod(size, blocksize)
+    blocks = list(blocks[:count + bool(tail)])
+
+    with readopen(filename, sequential=True) as (read, fd):
+        #: Spot-check the last complete block, the others are trusted
+        if count and not tail:
+            os.lseek(fd, (count - 1) * blocksize, os.SEEK_SET)
+            bufsizes = _sidebufsizes(blocksize, bufsize)
+            digest = _chunksum(fd, read, blocksize, bufsizes, (0, 0), hasher,
+                               counter)
+            if digest != blocks[-1]:
+                return None
+
+        os.lseek(fd, count * blocksize, os.SEEK_SET)
+
+        x = hasher.new()
+        update = x.update
+        filled = 0
+
+        while filled < tail:
+            data = read(min(bufsize, tail - filled))
+            if not data:
+                return None
+            update(data)
+            filled += len(data)
+
+            if counter is not None:
+                counter.done += len(data)
+
+        if tail and hasher.digest(x) != blocks.pop():
+            return None
+
+        while True:
+            data = read(min(bufsize, blocksize - filled))
+            if not data:
+                break
+            update(data)
+            filled += len(data)
+
+            if counter is not None:
+                counter.done += len(data)
+
+            if filled == blocksize:
+                blocks.append(hasher.digest(x))
+                x = hasher.new()
+                update = x.update
+                filled = 0
+
+        if filled:
+            blocks.append(hasher.digest(x))
+
+    return blocks
 
 
 def remove(path, trash=False, ignore_errors=False):
@@ -322,3 +751,66 @@ def remove(path, trash=False, ignore_errors=False):
 
     else:
         shutil.rmtree(path, ignore_errors)
+
+
+def _unlinkmany(dirname, names):
+    errors = []
+
+    #: Resolve the directory once, not for every entry
+    if os.unlink in getattr(os, 'supports_dir_fd', ()):
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            for name in names:
+                try:
+                    os.unlink(name, dir_fd=fd)
+                except OSError as exc:
+                    errors.append((name, exc))
+        finally:
+            os.close(fd)
+
+        return errors
+
+    for name in names:
+        try:
+            os.unlink(os.path.join(dirname, name))
+        except OSError as exc:
+            errors.append((name, exc))
+
+    return errors
+
+
+def _trashmany(dirname, names):
+    paths = [os.path.join(dirname, name) for name in names]
+
+    #: Recent send2trash versions trash a list of paths at once
+    try:
+        send2trash.send2trash(paths)
+
+    except Exception:
+        pass
+
+    else:
+        return []
+
+    errors = []
+
+    for name, path in zip(names, paths):
+        if not lexists(path):
+            continue
+        try:
+            remove(path, True)
+        except Exception as exc:
+            errors.append((name, exc))
+
+    return errors
+
+
+def removemany(dirname, names, trash=False):
+    """
+    Remove a batch of files of the same directory and
+    return the list of `(name, exception)` of the ones not removed.
+    """
+    if trash:
+        return _trashmany(dirname, names)
+
+    return _unlinkmany(dirname, names)
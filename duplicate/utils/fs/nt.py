@@ -44,6 +44,21 @@ def blksize(path):
     return size
 
 
+def iosize(path, blkdev=None):
+    """
+    Get the preferred I/O size (in bytes) reported for the file device.
+    """
+    return blksize(path)
+
+
+def physoffset(path, offset=0):
+    """
+    Get the physical offset (in bytes) on device of the file data at offset,
+    or `None` if unknown.
+    """
+    return None
+
+
 def has_archive_attribute(filename):
     try:
         st = lstat(filename)
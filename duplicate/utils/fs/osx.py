@@ -5,7 +5,8 @@ from __future__ import absolute_import
 from ..init import compilecards
 from .common import fsdecode
 from .posix import has_hidden_attribute as _has_hidden_attribute
-from .posix import has_archive_attribute, is_archived
+from .posix import (blksize, has_archive_attribute, iosize, is_archived,
+                    physoffset)
 
 
 WILDCARDS = (
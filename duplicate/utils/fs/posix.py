@@ -2,9 +2,16 @@
 
 from __future__ import absolute_import
 
+import os
 import stat
+import struct
 from os import lstat, statvfs
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from ..init import compilecards
 
 
@@ -20,6 +27,73 @@ def blksize(path):
     return statvfs(path).f_bsize
 
 
+def _queuesize(blkdev):
+    sysblock = os.path.join('/sys/class/block', blkdev)
+    sysqueue = os.path.join(sysblock, 'queue')
+
+    #: Partitions share the queue of their parent device
+    if not os.path.isdir(sysqueue):
+        sysqueue = os.path.join(sysblock, os.pardir, 'queue')
+
+    with open(os.path.join(sysqueue, 'optimal_io_size')) as fp:
+        return int(fp.read())
+
+
+def iosize(path, blkdev=None):
+    """
+    Get the preferred I/O size (in bytes) reported for the file device.
+    """
+    size = lstat(path).st_blksize
+
+    if blkdev:
+        try:
+            size = max(size, _queuesize(blkdev))
+        except (IOError, OSError, ValueError):
+            pass
+
+    return size
+
+
+#: struct fiemap and struct fiemap_extent of linux/fiemap.h
+_FIEMAP = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+_FIEMAP_EXTENT_UNKNOWN = 0x2
+_FS_IOC_FIEMAP = 0xC020660B
+
+
+def physoffset(path, offset=0):
+    """
+    Get the physical offset (in bytes) on device of the file data at offset,
+    or `None` if unknown.
+    """
+    if fcntl is None:
+        return None
+
+    request = _FIEMAP.pack(offset, 1, 0, 0, 1, 0)
+    request += b'\0' * _FIEMAP_EXTENT.size
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        reply = fcntl.ioctl(fd, _FS_IOC_FIEMAP, request)
+
+    except (IOError, OSError):
+        return None
+
+    finally:
+        os.close(fd)
+
+    if not _FIEMAP.unpack_from(reply)[3]:
+        return None
+
+    extent = _FIEMAP_EXTENT.unpack_from(reply, _FIEMAP.size)
+    logical, physical, flags = extent[0], extent[1], extent[5]
+
+    if flags & _FIEMAP_EXTENT_UNKNOWN:
+        return None
+
+    return physical + max(0, offset - logical)
+
+
 def has_archive_attribute(filename):
     try:
         st = lstat(filename)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import hashlib
+
+from collections import namedtuple
+
+import xxhash
+
+from .init import is_os64
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+Hasher = namedtuple('Hasher', 'name new digest blocksize')
+
+HASHERS = {}
+
+
+def _intdigest(x):
+    return x.intdigest()
+
+
+def _digest(x):
+    return x.digest()
+
+
+def register(name, new, digest=_digest, blocksize=None):
+    """
+    Register an hash algorithm under name.
+    """
+    if blocksize is None:
+        blocksize = getattr(new(), 'block_size', 64)
+
+    hasher = Hasher(name, new, digest, blocksize)
+    HASHERS[name] = hasher
+
+    return hasher
+
+
+register('xxh32', xxhash.xxh32, _intdigest)
+register('xxh64', xxhash.xxh64, _intdigest)
+
+try:
+    register('xxh3_64', xxhash.xxh3_64, _intdigest)
+    register('xxh3_128', xxhash.xxh3_128, _intdigest)
+
+except AttributeError:
+    DEFAULT_HASHER = 'xxh64' if is_os64() else 'xxh32'
+
+else:
+    DEFAULT_HASHER = 'xxh3_128'
+
+if hasattr(hashlib, 'blake2b'):
+    register('blake2b', hashlib.blake2b)
+
+if blake3 is not None:
+    register('blake3', blake3.blake3)
+
+
+def gethasher(name=None):
+    """
+    Get the registered hash algorithm by name (default if `None`).
+    """
+    if isinstance(name, Hasher):
+        return name
+
+    if name is None:
+        name = DEFAULT_HASHER
+
+    try:
+        hasher = HASHERS[name]
+
+    except KeyError:
+        raise ValueError('Unknown hash algorithm: {0}'.format(name))
+
+    return hasher
+
+
+def hashsum(data, hasher=None):
+    hasher = gethasher(hasher)
+    x = hasher.new()
+    x.update(data)
+    return hasher.digest(x)
@@ -56,6 +56,7 @@ setup(
         # 'ssd',
         'xxhash>=1'],
     setup_requires=['setuptools>=20.8.1'],
-    extras_require={'cli': ['deplicate-cli'], 'full': ['deplicate-cli']},
+    extras_require={'blake3': ['blake3'], 'cli': ['deplicate-cli'],
+                    'full': ['blake3', 'deplicate-cli']},
     python_requires='>=2.6,!=3.0,!=3.1,!=3.2',
     zip_safe=True)